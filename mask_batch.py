@@ -0,0 +1,255 @@
+"""Command-line batch auto-masking: runs the editor's import and auto mask over many image sets.
+
+Each job is a list of layer images. They are imported like File → Import
+Image, fitted to the target resolution, and auto-masked onto a white layer
+on top, which is then saved like File → Save Mask. Jobs run in a process
+pool; every finished job is appended to a JSON Lines report with its
+timings, and --resume skips jobs whose mask already exists.
+
+    python mask_batch.py INPUT -o OUTPUT [options]
+
+INPUT is either a directory with one subdirectory of layer images per job,
+or a JSON Lines manifest with one job per line.
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from mask_document import (
+    AUTO_MASK_MODES, DEFAULT_GRAY_BIN, DEFAULT_LAB, DEFAULT_PARALLEL_WORKERS, DEFAULT_RESOLUTION, IMPORT_MODES,
+    MaskDocument, fit_image, parse_gray_threshold, parse_lab_threshold, parse_resolution,
+)
+
+# ---------------------------- 
+# 配置与常量
+# ---------------------------- 
+BATCH_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")  # 目录模式下作为图层读取的文件类型
+BATCH_REPORT_NAME = "batch_report.jsonl"  # 默认的任务报告文件名（位于输出目录）
+FIT_MODES = {"scale": "缩放到目标分辨率", "pad": "居中，小图补白、大图裁掉边缘"}
+
+BatchSettings = collections.namedtuple("BatchSettings", [
+    "resolution", "fit", "threshold_lab", "threshold_gray",
+    "auto_mask_gray_threshold", "auto_mask_lab_threshold", "auto_mask_mode", "auto_mask_votes", "workers",
+])
+
+# ---------------------------- 
+# 任务列表
+# ---------------------------- 
+def parse_positive_int(value):
+    """value as an int if it is a whole number of at least 1, else None; raises ValueError if it is not an integer."""
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        return None
+    number = int(value)
+    return number if number >= 1 else None
+
+def scan_directory(root, output_dir, import_mode):
+    """Jobs for a directory layout: every subdirectory of root is a job whose layers are its images in name order."""
+    jobs = []
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        paths = sorted(os.path.join(entry.path, name) for name in os.listdir(entry.path)
+                       if name.lower().endswith(BATCH_IMAGE_EXTENSIONS))
+        jobs.append({
+            "name": entry.name,
+            "layers": [{"path": path, "mode": import_mode} for path in paths],
+            "output": os.path.join(output_dir, entry.name + ".png"),
+        })
+    return jobs
+
+def load_manifest(path, output_dir, import_mode):
+    """Jobs from a JSON Lines manifest; raises ValueError naming the line of a malformed entry.
+
+    Each line is an object with "layers", a list of image paths or of
+    {"path", "mode", "weight"} objects ("mode" is a key of IMPORT_MODES,
+    "weight" the layer's vote weight), and optionally "name" and "output".
+    Relative image paths are resolved against the manifest's directory,
+    relative outputs against output_dir.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                layers = []
+                for layer in entry["layers"]:
+                    if isinstance(layer, str):
+                        layer = {"path": layer}
+                    mode = layer.get("mode", import_mode)
+                    if mode not in IMPORT_MODES:
+                        raise ValueError(f"未知的导入方式 {mode!r}")
+                    item = {"path": os.path.join(base, layer["path"]), "mode": mode}
+                    if "weight" in layer:
+                        item["weight"] = parse_positive_int(layer["weight"])
+                        if item["weight"] is None:
+                            raise ValueError(f"投票权重必须为正整数：{layer['weight']!r}")
+                    layers.append(item)
+                name = str(entry.get("name") or os.path.splitext(os.path.basename(layers[0]["path"]))[0])
+                output = os.path.join(output_dir, entry.get("output") or name + ".png")
+                if not os.path.splitext(output)[1]:
+                    output += ".png"
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                raise ValueError(f"{path} 第 {number} 行无效：{e}") from e
+            jobs.append({"name": name, "layers": layers, "output": output})
+    return jobs
+
+# ---------------------------- 
+# 单个任务
+# ---------------------------- 
+def run_job(job, settings):
+    """Import the layers of one job, auto-mask them and write the mask; returns the timings in seconds."""
+    start = time.perf_counter()
+    doc = MaskDocument(settings.resolution, workers=settings.workers)
+    doc.record_history = False
+    doc.threshold_lab = settings.threshold_lab
+    doc.threshold_gray = settings.threshold_gray
+    doc.auto_mask_gray_threshold = settings.auto_mask_gray_threshold
+    doc.auto_mask_lab_threshold = settings.auto_mask_lab_threshold
+    doc.auto_mask_mode = settings.auto_mask_mode
+    doc.auto_mask_votes = settings.auto_mask_votes
+    doc.layers = []
+    for item in job["layers"]:
+        img = fit_image(doc.open_image(item["path"], item["mode"]), doc.target_resolution, pad=settings.fit == "pad")
+        layer = doc.add_layer(img)
+        if "weight" in item:
+            layer["vote_weight"] = item["weight"]
+    if not doc.layers:
+        raise ValueError("任务中没有图层图像")
+    doc.new_layer()  # 掩码画在最上面的白色图层上，保存的合成图即为该图层
+    loaded = time.perf_counter()
+    doc.auto_mask()
+    masked = time.perf_counter()
+    # 先写入临时文件再改名，中断时不会留下不完整的掩码被 --resume 误认为已完成
+    os.makedirs(os.path.dirname(job["output"]) or ".", exist_ok=True)
+    root, ext = os.path.splitext(job["output"])
+    partial = f"{root}.part{ext}"
+    doc.write_composite(partial)
+    os.replace(partial, job["output"])
+    saved = time.perf_counter()
+    return {"seconds": saved - start, "load": loaded - start, "mask": masked - loaded, "save": saved - masked}
+
+def run_jobs(jobs, settings, processes):
+    """Yield (job, timings) for every job in completion order; timings is the exception instead when the job failed.
+
+    With more than one process the jobs run in a spawn-started process
+    pool; jobs not yet started are cancelled if the caller stops early.
+    """
+    if processes <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            try:
+                yield job, run_job(job, settings)
+            except Exception as e:
+                yield job, e
+        return
+    executor = concurrent.futures.ProcessPoolExecutor(
+        min(processes, len(jobs)), mp_context=multiprocessing.get_context("spawn"))
+    futures = {executor.submit(run_job, job, settings): job for job in jobs}
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+# ---------------------------- 
+# 命令行
+# ---------------------------- 
+def _argument(parse, message):
+    """argparse type that applies parse and rejects its None results with message."""
+    def convert(text):
+        try:
+            value = parse(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e)) from e
+        if value is None or value == (None, None):
+            raise argparse.ArgumentTypeError(message)
+        return value
+    return convert
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="批量自动掩码：按目录或清单导入图层，以自动掩码生成掩码图并保存。")
+    parser.add_argument("input", help="任务目录（每个子目录为一个任务，其中的图像按文件名排序作为图层）或 JSON Lines 清单文件")
+    parser.add_argument("-o", "--output", required=True, help="掩码输出目录")
+    parser.add_argument("--resolution", type=_argument(parse_resolution, "分辨率无效"),
+                        default=DEFAULT_RESOLUTION, help="目标分辨率，如 640x480（默认 VGA）")
+    parser.add_argument("--import-mode", choices=IMPORT_MODES, default="gray", help="图层的导入处理方式（默认 gray）")
+    parser.add_argument("--fit", choices=FIT_MODES, default="scale",
+                        help="图像与目标分辨率不一致时的处理：" + "；".join(f"{k}={v}" for k, v in FIT_MODES.items()))
+    parser.add_argument("--threshold-lab", type=_argument(parse_lab_threshold, "LAB 阈值应为 Lmin,Lmax,Amin,Amax,Bmin,Bmax"),
+                        default=DEFAULT_LAB, help="导入二值化的 LAB 阈值")
+    parser.add_argument("--threshold-gray", type=_argument(parse_gray_threshold, "灰度阈值应为 min,max"),
+                        default=DEFAULT_GRAY_BIN, help="导入二值化的灰度阈值")
+    parser.add_argument("--gray-threshold", type=_argument(parse_gray_threshold, "灰度阈值应为 min,max"),
+                        help="自动掩码的灰度阈值 min,max（不设且未设 LAB 阈值时按白色像素计算）")
+    parser.add_argument("--lab-threshold", type=_argument(parse_lab_threshold, "LAB 阈值应为 Lmin,Lmax,Amin,Amax,Bmin,Bmax"),
+                        help="自动掩码的 LAB 阈值 Lmin,Lmax,Amin,Amax,Bmin,Bmax")
+    parser.add_argument("--combine", choices=AUTO_MASK_MODES, default="intersection", help="图层组合方式（默认 intersection）")
+    parser.add_argument("--votes", type=_argument(parse_positive_int, "票数必须为正整数"), default=1,
+                        help="vote 方式下像素被选中所需的最少（加权）票数")
+    parser.add_argument("-j", "--processes", type=int, default=DEFAULT_PARALLEL_WORKERS, help="并行进程数（默认 CPU 核数）")
+    parser.add_argument("--resume", action="store_true", help="跳过输出文件已存在的任务")
+    parser.add_argument("--report", help=f"任务报告文件（JSON Lines，追加写入；默认输出目录下的 {BATCH_REPORT_NAME}）")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        if os.path.isdir(args.input):
+            jobs = scan_directory(args.input, args.output, args.import_mode)
+        else:
+            jobs = load_manifest(args.input, args.output, args.import_mode)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    settings = BatchSettings(
+        args.resolution, args.fit, args.threshold_lab, args.threshold_gray, args.gray_threshold,
+        args.lab_threshold, args.combine, args.votes,
+        # 多进程时每个任务单线程处理，避免线程数超过核数
+        1 if args.processes > 1 else DEFAULT_PARALLEL_WORKERS)
+    os.makedirs(args.output, exist_ok=True)
+    start = time.perf_counter()
+    counts = collections.Counter()
+    total = len(jobs)
+    with open(args.report or os.path.join(args.output, BATCH_REPORT_NAME), "a", encoding="utf-8") as report:
+        def record(job, status, message, **fields):
+            counts[status] += 1
+            entry = {"job": job["name"], "output": job["output"], "status": status}
+            entry.update({k: round(v, 4) if isinstance(v, float) else v for k, v in fields.items()})
+            report.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            report.flush()
+            print(f"[{sum(counts.values())}/{total}] {job['name']}：{message}", file=sys.stderr, flush=True)
+
+        pending = []
+        for job in jobs:
+            if args.resume and os.path.exists(job["output"]):
+                record(job, "skipped", "已存在，跳过")
+            else:
+                pending.append(job)
+        try:
+            for job, result in run_jobs(pending, settings, args.processes):
+                if isinstance(result, Exception):
+                    record(job, "failed", f"失败：{result}", error=str(result))
+                else:
+                    record(job, "done", f"完成，用时 {result['seconds']:.2f} 秒", **result)
+        except KeyboardInterrupt:
+            print("已中断，可使用 --resume 继续", file=sys.stderr)
+            return 130
+    print(f"完成 {counts['done']} 个，跳过 {counts['skipped']} 个，失败 {counts['failed']} 个，"
+          f"用时 {time.perf_counter() - start:.1f} 秒", file=sys.stderr)
+    return 1 if counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
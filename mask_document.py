@@ -0,0 +1,2408 @@
+"""Headless core of the mask editor: the layer model, edit operations, history and file I/O.
+
+Nothing here imports Tk, so batch jobs can use MaskDocument on machines
+without a display; mask_editor.MaskEditorApp is a view over it.
+"""
+from PIL import Image
+import numpy as np
+import cv2
+import platform
+import collections
+import concurrent.futures
+import itertools
+import math
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import weakref
+import zlib
+from multiprocessing import shared_memory
+
+# ---------------------------- 
+# 配置与常量
+# ---------------------------- 
+DEFAULT_RESOLUTION = (640, 480)  # 默认 VGA 分辨率
+DEFAULT_LAB = (0, 200, 100, 150, 100, 150)  # Lmin,Lmax,Amin,Amax,Bmin,Bmax
+DEFAULT_GRAY_BIN = (0, 128)  # min,max for gray bin
+DEFAULT_AUTO_MASK_GRAY_THRESHOLD = None  # Default auto-mask gray threshold (min, max), None means not set
+DEFAULT_AUTO_MASK_LAB_THRESHOLD = None   # Default auto-mask LAB threshold, None means not set
+DEFAULT_AUTO_MASK_MODE = "intersection"  # 自动掩码的图层组合方式：intersection / union / vote
+AUTO_MASK_MODES = {"intersection": "交集", "union": "并集", "vote": "投票"}
+IMPORT_MODES = {"gray": "灰度化", "binary": "二值化", "color": "彩色化"}  # 导入时的处理方式
+PYRAMID_TILE_SIZE = 256  # 缩小显示用图像金字塔的分块边长（像素）
+DEFAULT_HISTORY_BUDGET_MB = 512  # 撤销历史的内存上限（MB）
+HISTORY_KEEP_RECENT = 4  # 最近的若干条历史始终保持未压缩
+HISTORY_TILE_SIZE = 64  # 历史快照按该边长分块比较与存储
+HISTORY_DISK_BUDGET_FACTOR = 8  # 溢出到磁盘的历史上限 = 内存上限 × 该倍数
+HISTORY_MAX_TILES = 4096  # 单个历史快照的块数上限，超大图层按需加大块边长
+TILED_LAYER_MIN_PIXELS = 8192 * 8192  # 像素数达到该值的图层改用磁盘分块存储
+TILED_TILE_SIZE = 512  # 分块图层的块边长（像素）
+TILED_CACHE_TILES = 128  # 每个分块图层在内存中缓存的块数
+TILED_OVERVIEW_SIZE = 2048  # 分块图层内存概览图的最长边上限（像素）
+PLANE_CACHE_BUDGET_MB = 256  # 派生平面（缩放/灰度/LAB）缓存的内存上限（MB）
+PREVIEW_PROXY_SIZE = 360  # 阈值实时预览所用缩小代理图的最长边（像素）
+LAB_HISTOGRAM_BIN = 8  # LAB 三维直方图每个通道的分箱宽度（取值个数）
+DEFAULT_PARALLEL_WORKERS = 1 if platform.system() == "Emscripten" else os.cpu_count() or 1  # 分条并行处理的线程数
+PARALLEL_MIN_STRIPE_ROWS = 64  # 并行处理时每个水平条带的最少行数
+PARALLEL_PROCESS_MIN_PIXELS = 8192 * 8192  # 像素数达到该值的导入图像改由进程池经共享内存处理
+
+# ---------------------------- 
+# 工具函数
+# ---------------------------- 
+def pil_to_cv(img_pil):
+    return cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
+
+def cv_to_pil(img_cv):
+    return Image.fromarray(cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB))
+
+def ensure_binary_np(arr, thresh=128):
+    return np.where(arr > thresh, 255, 0).astype(np.uint8)
+
+_layer_versions = itertools.count(1)
+
+def touch_layer(layer):
+    """Bump the content version of a layer whose image was modified in place."""
+    layer["version"] = next(_layer_versions)
+
+def layer_vote_weight(layer):
+    """The layer's "vote_weight" (1 if unset); raises ValueError unless it is a positive integer."""
+    weight = layer.get("vote_weight", 1)
+    if isinstance(weight, bool) or not isinstance(weight, (int, np.integer)) or weight < 1:
+        raise ValueError(f"图层 {layer.get('name', '')} 的投票权重必须为正整数：{weight!r}")
+    return int(weight)
+
+def union_rect(a, b):
+    """Bounding box of two (x0, y0, x1, y1) rectangles; None stands for an empty rectangle."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def clip_rect(rect, size):
+    """Clip a rectangle to an image of the given size; returns None when nothing is left."""
+    x0, y0, x1, y1 = rect
+    x0, y0 = max(0, int(x0)), max(0, int(y0))
+    x1, y1 = min(size[0], int(x1)), min(size[1], int(y1))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1, y1)
+
+def composite_layers(layers, target_size, mode="L", apply_alpha=False):
+    """Create a composite image from visible layers with optional alpha blending."""
+    return LayerCompositor().composite(layers, target_size, mode, apply_alpha)
+
+_pixel_buffers = {}
+
+def image_view(arr):
+    """Zero-copy "L" image over a C-contiguous 2-D uint8 array.
+
+    PIL treats the view as read-only and would silently copy it on the first
+    ImageDraw/paste write, so the pixels must be modified through arr.
+    """
+    h, w = arr.shape
+    img = Image.frombuffer("L", (w, h), arr, "raw", "L", 0, 1)
+    key = id(img)
+    _pixel_buffers[key] = (weakref.ref(img, lambda _, key=key: _pixel_buffers.pop(key, None)), arr)
+    return img
+
+def pixel_buffer(img):
+    """The array behind an image made by image_view(), or None."""
+    entry = _pixel_buffers.get(id(img))
+    # readonly 被清除说明 PIL 已把图像复制出去，不再共享该数组
+    if entry is not None and entry[0]() is img and img.readonly:
+        return entry[1]
+    return None
+
+def image_array(img):
+    """Pixels of img as an array, without copying when img is a view; treat the result as read-only."""
+    arr = pixel_buffer(img)
+    return arr if arr is not None else np.asarray(img)
+
+def write_png_strips(path, size, mode, strips):
+    """Write an 8-bit "L" or "RGB" PNG from an iterable of row-strip arrays, never holding the whole image."""
+    w, h = size
+    color_type = 0 if mode == "L" else 2
+
+    def chunk(f, tag, data):
+        f.write(struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        chunk(f, b"IHDR", struct.pack(">IIBBBBB", w, h, 8, color_type, 0, 0, 0))
+        compressor = zlib.compressobj(6)
+        for strip in strips:
+            rows = np.ascontiguousarray(strip).reshape(strip.shape[0], -1)
+            filtered = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)  # 每行前加滤波类型 0
+            filtered[:, 1:] = rows
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                chunk(f, b"IDAT", data)
+        chunk(f, b"IDAT", compressor.flush())
+        chunk(f, b"IEND", b"")
+
+def binary_for_save(img):
+    """Return a mode "1" copy of a pure black/white "L" image (saved as a 1-bit PNG), otherwise img itself."""
+    packed = PackedMask.pack(img)
+    return packed.to_bitmap() if packed is not None else img
+
+# ---------------------------- 
+# 位压缩二值图层
+# ---------------------------- 
+class PackedMask:
+    """Read-only black/white layer image stored at 1 bit per pixel.
+
+    Idle mask layers are kept in this form inside the layer list (see
+    MaskEditorApp._pack_idle_layers) and expanded lazily: crop() unpacks only
+    the requested rows, np.asarray() and to_image() give the full 0/255 "L"
+    image. It provides the part of the PIL Image interface used by code that
+    only reads layers (mode, size, crop, resize, convert, copy); a layer is
+    unpacked back to a PIL image before it is edited. bits holds one row of
+    np.packbits output per image row, white pixels set.
+    """
+
+    __slots__ = ("size", "bits", "__weakref__")
+    mode = "L"
+
+    def __init__(self, size, bits):
+        self.size = tuple(size)
+        self.bits = bits
+        self.bits.flags.writeable = False
+
+    @classmethod
+    def from_array(cls, arr):
+        """Pack a 2-D array known to hold only 0 and 255."""
+        h, w = arr.shape
+        return cls((w, h), np.packbits(arr == 255, axis=1))
+
+    @classmethod
+    def pack(cls, img):
+        """Pack img if it is an "L" or "1" image holding only black and white, else return None."""
+        if isinstance(img, PackedMask):
+            return img
+        if img.mode == "1":
+            w, h = img.size
+            return cls(img.size, np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(h, -(-w // 8)).copy())
+        if img.mode != "L":
+            return None
+        arr = np.asarray(img)
+        white = arr == 255
+        if np.count_nonzero(white) + np.count_nonzero(arr == 0) != arr.size:
+            return None
+        h, w = arr.shape
+        return cls((w, h), np.packbits(white, axis=1))
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _unpack(self, bits, x0, x1):
+        arr = np.unpackbits(bits, axis=1, count=x1)[:, x0:]
+        arr = np.ascontiguousarray(arr)
+        arr *= np.uint8(255)
+        return arr
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self._unpack(self.bits, 0, self.size[0])
+        return arr if dtype is None else arr.astype(dtype)
+
+    def to_image(self):
+        return Image.fromarray(np.asarray(self), mode="L")
+
+    def to_bitmap(self):
+        """The same pixels as a PIL mode "1" image, built straight from the packed rows."""
+        return Image.frombytes("1", self.size, self.bits.tobytes())
+
+    def crop(self, box):
+        x0, y0, x1, y1 = (int(v) for v in box)
+        w, h = self.size
+        if x0 < 0 or y0 < 0 or x1 > w or y1 > h or x1 <= x0 or y1 <= y0:
+            return self.to_image().crop(box)
+        b0 = x0 // 8
+        bits = self.bits[y0:y1, b0:-(-x1 // 8)]
+        return Image.fromarray(self._unpack(bits, x0 - b0 * 8, x1 - b0 * 8), mode="L")
+
+    def resize(self, size, resample=None, **kwargs):
+        return self.to_image().resize(size, resample, **kwargs)
+
+    def convert(self, mode, **kwargs):
+        return self.to_image() if mode == "L" else self.to_image().convert(mode, **kwargs)
+
+    def copy(self):
+        return self  # 只读，可直接共享
+
+class BitCounter:
+    """Per-pixel vote counter over np.packbits rows of a fixed shape.
+
+    The counts are stored bit-sliced: planes[i] holds bit i of every pixel's
+    count, packed like the input. Adding a mask ripples a carry through the
+    planes with whole-array bitwise operations (a few per add on average),
+    and at_least() compares all counts with a constant the same way, so no
+    per-layer or per-pixel integer arrays are ever built.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.planes = []
+        self._carry = np.empty(shape, dtype=np.uint8)
+        self._next = np.empty(shape, dtype=np.uint8)
+
+    def add(self, bits, weight=1):
+        """Add weight (a positive integer) to the count of every pixel set in bits."""
+        if weight < 1:
+            raise ValueError(f"投票权重必须为正整数：{weight}")
+        plane = 0
+        while weight:
+            if weight & 1:
+                self._add_at(bits, plane)
+            weight >>= 1
+            plane += 1
+
+    def _add_at(self, bits, plane):
+        carry, nxt = self._carry, self._next
+        np.copyto(carry, bits)
+        while True:
+            while plane >= len(self.planes):
+                self.planes.append(np.zeros(self.shape, dtype=np.uint8))
+            counts = self.planes[plane]
+            np.bitwise_and(counts, carry, out=nxt)
+            np.bitwise_xor(counts, carry, out=counts)
+            carry, nxt = nxt, carry
+            if not carry.any():
+                return
+            plane += 1
+
+    def at_least(self, k):
+        """Packed mask of the pixels whose count is at least k."""
+        if k <= 0:
+            return np.full(self.shape, 0xFF, dtype=np.uint8)
+        if k >= 1 << len(self.planes):
+            return np.zeros(self.shape, dtype=np.uint8)
+        # 从最高位向低位逐位比较：greater 为已确定大于 k 的像素，equal 为目前各位均与 k 相同的像素
+        greater = np.zeros(self.shape, dtype=np.uint8)
+        equal = np.full(self.shape, 0xFF, dtype=np.uint8)
+        for i in reversed(range(len(self.planes))):
+            counts = self.planes[i]
+            if (k >> i) & 1:
+                equal &= counts
+            else:
+                greater |= equal & counts
+                equal &= ~counts
+        return greater | equal
+
+# ---------------------------- 
+# 分块图层存储
+# ---------------------------- 
+def use_tiled_storage(size):
+    """True if a layer of this size is kept in a TiledImage rather than in memory."""
+    return size[0] * size[1] >= TILED_LAYER_MIN_PIXELS
+
+def level_size(size, level):
+    """Size of an image reduced by 2**level (Image.reduce rounds up)."""
+    f = 1 << level
+    return -(-size[0] // f), -(-size[1] // f)
+
+def new_layer_image(size):
+    """Blank white "L" layer image of the given size, tiled on disk when it is very large."""
+    return TiledImage(size) if use_tiled_storage(size) else Image.new("L", size, 255)
+
+def to_layer_storage(img):
+    """img itself, or a TiledImage copy of it when its size calls for tiled storage."""
+    if isinstance(img, TiledImage) or not use_tiled_storage(img.size):
+        return img
+    return TiledImage.from_image(img)
+
+def resize_layer_image(img, size):
+    """LANCZOS-resize a layer image; a result that needs tiled storage is produced strip by strip."""
+    if not use_tiled_storage(size):
+        return img.resize(size, Image.Resampling.LANCZOS)
+    out = TiledImage(size, img.mode)
+    sy = img.height / size[1]
+    for y0 in range(0, size[1], TILED_TILE_SIZE):
+        y1 = min(size[1], y0 + TILED_TILE_SIZE)
+        strip = img.resize((size[0], y1 - y0), Image.Resampling.LANCZOS, box=(0, y0 * sy, img.width, y1 * sy))
+        out.write((0, y0, size[0], y1), np.asarray(strip))
+    return out
+
+class TiledImage:
+    """White-initialised layer image kept on disk as a grid of TILED_TILE_SIZE tiles.
+
+    Used for canvases too large to hold in memory. The pixels live in an
+    np.memmap temporary file; a tile is copied into a per-image LRU cache of
+    TILED_CACHE_TILES entries when it is read or edited and written back when
+    evicted, so only the tiles being viewed or edited are resident. Tiles that
+    were never written are not stored at all and read as white.
+
+    An overview (the image reduced by 2**overview_level, at most
+    TILED_OVERVIEW_SIZE on its longer side) is kept in memory and refreshed
+    per tile after edits; region() serves zoomed-out views from it.
+
+    It offers the parts of the PIL Image interface the editor uses on layers
+    (mode, size, crop, paste, resize, convert, copy). read() and write() take
+    (x0, y0, x1, y1) boxes that lie inside the image.
+    """
+
+    def __init__(self, size, mode="L"):
+        self.size = tuple(size)
+        self.mode = mode
+        self.fill = 255 if mode == "L" else (255, 255, 255)
+        t = TILED_TILE_SIZE
+        self._channels = () if mode == "L" else (3,)
+        rows, cols = -(-self.size[1] // t), -(-self.size[0] // t)
+        fd, path = tempfile.mkstemp(suffix=".tiles")
+        os.close(fd)
+        self._store = np.memmap(path, dtype=np.uint8, mode="w+", shape=(rows, cols, t, t) + self._channels)
+        weakref.finalize(self, TiledImage._release, self._store, path)
+        self._written = np.zeros((rows, cols), dtype=bool)
+        self._cache = collections.OrderedDict()
+        self._dirty = set()
+        self.overview_level = 0
+        while max(level_size(self.size, self.overview_level)) > TILED_OVERVIEW_SIZE and (2 << self.overview_level) <= t:
+            self.overview_level += 1
+        self._overview = Image.new(mode, level_size(self.size, self.overview_level), self.fill)
+        self._overview_dirty = set()
+
+    @staticmethod
+    def _release(store, path):
+        mapping = getattr(store, "_mmap", None)
+        if mapping is not None:
+            try:
+                mapping.close()
+            except (BufferError, ValueError):
+                pass
+        _remove_quietly(path)
+
+    @classmethod
+    def from_image(cls, img):
+        tiled = cls(img.size, img.mode)
+        for y0 in range(0, img.height, TILED_TILE_SIZE):
+            y1 = min(img.height, y0 + TILED_TILE_SIZE)
+            tiled.write((0, y0, img.width, y1), np.asarray(img.crop((0, y0, img.width, y1))))
+        return tiled
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    def _tile_rect(self, ty, tx):
+        t = TILED_TILE_SIZE
+        return tx * t, ty * t, min(self.size[0], (tx + 1) * t), min(self.size[1], (ty + 1) * t)
+
+    def _tiles_in(self, box):
+        """(ty, tx, part of box inside that tile) for every tile overlapping box."""
+        x0, y0, x1, y1 = box
+        t = TILED_TILE_SIZE
+        for ty in range(y0 // t, -(-y1 // t)):
+            for tx in range(x0 // t, -(-x1 // t)):
+                tx0, ty0, tx1, ty1 = self._tile_rect(ty, tx)
+                yield ty, tx, (max(x0, tx0), max(y0, ty0), min(x1, tx1), min(y1, ty1))
+
+    def _tile(self, ty, tx, for_write=False):
+        key = (ty, tx)
+        arr = self._cache.get(key)
+        if arr is not None:
+            self._cache.move_to_end(key)
+        else:
+            if self._written[key]:
+                arr = np.array(self._store[key])
+            else:
+                arr = np.empty(self._store.shape[2:], dtype=np.uint8)
+                arr[...] = self.fill
+            self._cache[key] = arr
+            while len(self._cache) > TILED_CACHE_TILES:
+                old, old_arr = self._cache.popitem(last=False)
+                if old in self._dirty:
+                    self._store[old] = old_arr
+                    self._dirty.discard(old)
+        if for_write:
+            self._dirty.add(key)
+            self._written[key] = True
+            self._overview_dirty.add(key)
+        return arr
+
+    def flush(self):
+        """Write every modified cached tile back to the file."""
+        for key in self._dirty:
+            self._store[key] = self._cache[key]
+        self._dirty.clear()
+
+    def is_blank(self, box):
+        """True if no tile overlapping box was ever written, i.e. box is known to be white."""
+        t = TILED_TILE_SIZE
+        return not self._written[box[1] // t:-(-box[3] // t), box[0] // t:-(-box[2] // t)].any()
+
+    def read(self, box):
+        x0, y0, x1, y1 = box
+        t = TILED_TILE_SIZE
+        out = np.empty((y1 - y0, x1 - x0) + self._channels, dtype=np.uint8)
+        for ty, tx, (ax0, ay0, ax1, ay1) in self._tiles_in(box):
+            dst = out[ay0 - y0:ay1 - y0, ax0 - x0:ax1 - x0]
+            if not self._written[ty, tx]:
+                dst[...] = self.fill
+                continue
+            tile = self._tile(ty, tx)
+            dst[...] = tile[ay0 - ty * t:ay1 - ty * t, ax0 - tx * t:ax1 - tx * t]
+        return out
+
+    def write(self, box, value):
+        """Set box to value, a colour or an array of the box's shape."""
+        x0, y0 = box[:2]
+        t = TILED_TILE_SIZE
+        is_array = isinstance(value, np.ndarray)
+        for ty, tx, (ax0, ay0, ax1, ay1) in self._tiles_in(box):
+            tile = self._tile(ty, tx, for_write=True)
+            dst = tile[ay0 - ty * t:ay1 - ty * t, ax0 - tx * t:ax1 - tx * t]
+            dst[...] = value[ay0 - y0:ay1 - y0, ax0 - x0:ax1 - x0] if is_array else value
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.read((0, 0) + self.size)
+        return arr if dtype is None else arr.astype(dtype)
+
+    def crop(self, box):
+        x0, y0, x1, y1 = (int(v) for v in box)
+        inner = clip_rect((x0, y0, x1, y1), self.size)
+        if inner == (x0, y0, x1, y1):
+            return Image.fromarray(self.read(inner))
+        out = np.zeros((max(0, y1 - y0), max(0, x1 - x0)) + self._channels, dtype=np.uint8)
+        if inner is not None:
+            out[inner[1] - y0:inner[3] - y0, inner[0] - x0:inner[2] - x0] = self.read(inner)
+        return Image.fromarray(out)
+
+    def paste(self, im, box=None):
+        """PIL-style paste of a colour into a box, or of an image at an (x, y) or box origin."""
+        if isinstance(im, Image.Image):
+            x0, y0 = box[:2]
+            rect = (x0, y0, x0 + im.width, y0 + im.height)
+            value = np.asarray(im if im.mode == self.mode else im.convert(self.mode))
+        else:
+            rect, value = box, im
+        inner = clip_rect(rect, self.size)
+        if inner is None:
+            return
+        if isinstance(value, np.ndarray):
+            value = value[inner[1] - rect[1]:inner[3] - rect[1], inner[0] - rect[0]:inner[2] - rect[0]]
+        self.write(inner, value)
+
+    def _refresh_overview(self):
+        f = 1 << self.overview_level
+        for ty, tx in self._overview_dirty:
+            rect = self._tile_rect(ty, tx)
+            block = Image.fromarray(self.read(rect))
+            self._overview.paste(block.reduce(f) if f > 1 else block, (rect[0] // f, rect[1] // f))
+        self._overview_dirty.clear()
+
+    def region(self, level, box):
+        """Box (in 1/2**level coordinates, inside that level) of the image reduced by 2**level."""
+        if level >= self.overview_level:
+            self._refresh_overview()
+            src = self._overview
+            if level > self.overview_level:
+                src = src.reduce(1 << (level - self.overview_level))
+            return src.crop(box)
+        f = 1 << level
+        img = self.crop((box[0] * f, box[1] * f, min(self.width, box[2] * f), min(self.height, box[3] * f)))
+        return img.reduce(f) if f > 1 else img
+
+    def resize(self, size, resample=None, box=None, **kwargs):
+        """PIL-style resize that reads only box, from the coarsest level that still has enough detail."""
+        if box is None:
+            box = (0, 0) + self.size
+        scale = min((box[2] - box[0]) / size[0], (box[3] - box[1]) / size[1])
+        level = 0
+        while (2 << level) <= scale:
+            level += 1
+        f = 1 << level
+        lw, lh = level_size(self.size, level)
+        margin = 3 * math.ceil(scale / f) + 1
+        ibox = (max(0, int(box[0] / f) - margin), max(0, int(box[1] / f) - margin),
+                min(lw, math.ceil(box[2] / f) + margin), min(lh, math.ceil(box[3] / f) + margin))
+        src = self.region(level, ibox)
+        return src.resize(size, resample, box=(box[0] / f - ibox[0], box[1] / f - ibox[1],
+                                               box[2] / f - ibox[0], box[3] / f - ibox[1]), **kwargs)
+
+    def convert(self, mode, **kwargs):
+        if mode == self.mode:
+            return self.copy()
+        out = TiledImage(self.size, mode)
+        for ty, tx in zip(*np.nonzero(self._written)):
+            rect = self._tile_rect(ty, tx)
+            out.write(rect, np.asarray(self.crop(rect).convert(mode, **kwargs)))
+        return out
+
+    def copy(self):
+        self.flush()
+        clone = TiledImage(self.size, self.mode)
+        for ty, tx in zip(*np.nonzero(self._written)):
+            clone._store[ty, tx] = self._store[ty, tx]
+        clone._written[...] = self._written
+        self._refresh_overview()
+        clone._overview = self._overview.copy()
+        return clone
+
+    def content_bbox(self):
+        """Bounding box of the non-white pixels (gray value below 255), or None; only written tiles are read."""
+        bbox = None
+        for ty, tx in zip(*np.nonzero(self._written)):
+            rect = self._tile_rect(ty, tx)
+            arr = self.read(rect)
+            if arr.ndim == 3:
+                arr = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
+            rows, cols = np.nonzero(arr != 255)
+            if rows.size:
+                bbox = union_rect(bbox, (rect[0] + int(cols.min()), rect[1] + int(rows.min()),
+                                         rect[0] + int(cols.max()) + 1, rect[1] + int(rows.max()) + 1))
+        return bbox
+
+# ---------------------------- 
+# 图层合成
+# ---------------------------- 
+class LayerCompositor:
+    """Cached, versioned layer compositor.
+
+    Keeps the partial composite up to and including every layer, keyed on a
+    per-layer signature (image identity, content version and display flags).
+    A call after an edit reuses the partial below the lowest changed layer and
+    only rebuilds the stack from there upward; an unchanged stack returns the
+    cached result without touching any pixels.
+
+    Edits reported through mark_dirty() are recomposited inside their bounding
+    box only, updating the cached partials in place. After every composite()
+    call, dirty_rect tells the caller what changed: None for the whole frame,
+    otherwise an (x0, y0, x1, y1) rectangle that is empty when nothing changed.
+
+    For zoomed-out display the result is also available as an image pyramid
+    (1/2, 1/4, ...) through pyramid_level(). Levels are built on first use and
+    split into PYRAMID_TILE_SIZE tiles; a regional edit only marks the tiles
+    it overlaps, which are re-reduced the next time the level is requested.
+    Cached images are shared and must be treated as read-only by callers.
+    """
+
+    def __init__(self):
+        self._key = None
+        self._signatures = []
+        self._partials = []
+        self._base = None
+        self._pending = {}
+        self._pyramid = []
+        self._pyramid_dirty = []
+        self.dirty_rect = None
+
+    def invalidate(self):
+        """Drop every cached partial composite."""
+        self._key = None
+        self._signatures = []
+        self._partials = []
+        self._base = None
+        self._pending = {}
+        self._pyramid = []
+        self._pyramid_dirty = []
+
+    @property
+    def result(self):
+        """The current flattened composite (read-only)."""
+        return self._partials[-1] if self._partials else self._base
+
+    @staticmethod
+    def level_for_scale(scale):
+        """Pyramid level whose resolution is the smallest one not below scale."""
+        if scale >= 1.0:
+            return 0
+        return int(math.floor(math.log2(1.0 / scale) + 1e-9))
+
+    def pyramid_level(self, level):
+        """Return the composite reduced by 2**level, building or refreshing tiles as needed.
+
+        The level is capped where the image would drop below 2 pixels, so the
+        returned image may be larger than requested.
+        """
+        src = self.result
+        for k in range(1, level + 1):
+            if k > len(self._pyramid):
+                if src.width < 2 or src.height < 2:
+                    break
+                self._pyramid.append(src.reduce(2))
+                self._pyramid_dirty.append(set())
+            else:
+                self._refresh_pyramid_tiles(src, k)
+            src = self._pyramid[k - 1]
+        return src
+
+    def _refresh_pyramid_tiles(self, src, k):
+        dst = self._pyramid[k - 1]
+        t = PYRAMID_TILE_SIZE
+        for tx, ty in self._pyramid_dirty[k - 1]:
+            x0, y0 = tx * t, ty * t
+            x1, y1 = min(dst.width, x0 + t), min(dst.height, y0 + t)
+            box = (x0 * 2, y0 * 2, min(src.width, x1 * 2), min(src.height, y1 * 2))
+            dst.paste(src.reduce(2, box=box), (x0, y0))
+        self._pyramid_dirty[k - 1].clear()
+
+    def _mark_pyramid(self, rect):
+        x0, y0, x1, y1 = rect
+        if x1 <= x0 or y1 <= y0:
+            return
+        t = PYRAMID_TILE_SIZE
+        for k, dirty in enumerate(self._pyramid_dirty, start=1):
+            f = 1 << k
+            lx0, ly0 = x0 // f, y0 // f
+            lx1, ly1 = -(-x1 // f), -(-y1 // f)
+            for ty in range(ly0 // t, (ly1 - 1) // t + 1):
+                for tx in range(lx0 // t, (lx1 - 1) // t + 1):
+                    dirty.add((tx, ty))
+
+    @staticmethod
+    def _signature(layer):
+        return (layer["image"], layer.get("version", 0), layer["visible"], layer["hidden"], layer.get("alpha", 1.0))
+
+    @staticmethod
+    def _same(sig_a, sig_b):
+        return sig_a[0] is sig_b[0] and sig_a[1:] == sig_b[1:]
+
+    def replace_image(self, old, new):
+        """Swap old for new (same pixels, e.g. packed and unpacked forms) without invalidating anything."""
+        self._signatures = [(new,) + sig[1:] if sig[0] is old else sig for sig in self._signatures]
+        entry = self._pending.pop(id(old), None)
+        if entry is not None and entry[0] is old:
+            self._pending[id(new)] = (new,) + entry[1:]
+
+    def mark_dirty(self, layer, rect):
+        """Record an in-place edit of layer confined to rect and bump its version."""
+        img = layer["image"]
+        prev_version = layer.get("version", 0)
+        touch_layer(layer)
+        entry = self._pending.get(id(img))
+        if entry is not None and entry[0] is img and entry[1] == prev_version:
+            rect = union_rect(entry[2], rect)
+        elif not any(sig[0] is img and sig[1] == prev_version for sig in self._signatures):
+            # 未见过的基准版本，下次合成时整体重建
+            self._pending.pop(id(img), None)
+            return
+        self._pending[id(img)] = (img, layer["version"], rect)
+
+    def _pending_rect(self, signatures, target_size):
+        """Union of the pending edit rectangles, or None if some change is not a known in-place edit."""
+        rect = None
+        for old, new in zip(self._signatures, signatures):
+            if self._same(old, new):
+                continue
+            img = new[0]
+            entry = self._pending.get(id(img))
+            if (old[0] is not img or old[2:] != new[2:] or img.size != target_size
+                    or entry is None or entry[0] is not img or entry[1] != new[1]):
+                return None
+            rect = union_rect(rect, entry[2])
+        if rect is not None:
+            rect = clip_rect(rect, target_size)
+        return rect or (0, 0, 0, 0)
+
+    def composite(self, layers, target_size, mode="L", apply_alpha=False):
+        key = (tuple(target_size), mode, apply_alpha)
+        if key != self._key:
+            self.invalidate()
+            self._key = key
+            self._base = Image.new(mode, target_size, 255)
+        signatures = [self._signature(layer) for layer in layers]
+        start = 0
+        while (start < len(signatures) and start < len(self._signatures)
+               and self._same(signatures[start], self._signatures[start])):
+            start += 1
+        if start == len(signatures) == len(self._signatures):
+            self._pending.clear()
+            self.dirty_rect = (0, 0, 0, 0)
+            return self._partials[-1] if self._partials else self._base
+        rect = None
+        if len(signatures) == len(self._signatures):
+            rect = self._pending_rect(signatures, tuple(target_size))
+        self._pending.clear()
+        if rect is not None:
+            self._recomposite_region(layers, start, rect, apply_alpha)
+            self._mark_pyramid(rect)
+            self._signatures = signatures
+            self.dirty_rect = rect
+            return self._partials[-1]
+        self._pyramid = []
+        self._pyramid_dirty = []
+        del self._partials[start:]
+        composite = self._partials[-1] if self._partials else self._base
+        for layer in layers[start:]:
+            composite = self._apply_layer(composite, layer, target_size, apply_alpha)
+            self._partials.append(composite)
+        self._signatures = signatures
+        self.dirty_rect = None
+        return composite
+
+    def _recomposite_region(self, layers, start, rect, apply_alpha):
+        """Redraw rect of every partial from layer start upward, in place."""
+        if rect == (0, 0, 0, 0):
+            return
+        for i in range(start, len(layers)):
+            below = self._partials[i - 1] if i > 0 else self._base
+            if self._partials[i] is below:
+                continue  # 该图层不参与合成，与下方共享同一图像
+            patch = self._apply_layer(below.crop(rect), layers[i], None, apply_alpha, crop=rect)
+            self._partials[i].paste(patch, rect[:2])
+
+    @classmethod
+    def region(cls, layers, target_size, level, box, mode="L", apply_alpha=False):
+        """Composite of box (in 1/2**level coordinates of the target frame) built from that region alone.
+
+        Used instead of composite() when layers are TiledImages: nothing is
+        cached and only the tiles (or overview) under box are read.
+        """
+        f = 1 << level
+        composite = Image.new(mode, (box[2] - box[0], box[3] - box[1]), 255)
+        for layer in layers:
+            img = layer["image"]
+            if not (layer["visible"] and img and not layer["hidden"]):
+                continue
+            if isinstance(img, TiledImage) and img.size == tuple(target_size):
+                patch = img.region(level, box)
+            else:
+                # 尺寸不同的图层按缩放到目标尺寸后的坐标取样
+                sx, sy = img.width * f / target_size[0], img.height * f / target_size[1]
+                patch = img.resize(composite.size, Image.Resampling.LANCZOS,
+                                   box=(box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy))
+            composite = cls._apply_layer(composite, dict(layer, image=patch), composite.size, apply_alpha)
+        return composite
+
+    @staticmethod
+    def _apply_layer(composite, layer, target_size, apply_alpha, crop=None):
+        """Return a new image with one layer drawn over composite (composite itself is never modified).
+
+        With crop set, composite is a crop of the frame and only that part of
+        the layer is used.
+        """
+        if not (layer["visible"] and layer["image"] and not layer["hidden"]):
+            return composite
+        img = layer["image"]
+        if crop is not None:
+            img = img.crop(crop)
+        elif img.size != target_size:
+            img = img.resize(target_size, Image.Resampling.LANCZOS)
+        elif isinstance(img, PackedMask):
+            img = img.to_image()
+        if composite.mode == "RGB" and img.mode != "RGB":
+            img = img.convert("RGB")
+        elif composite.mode == "L" and img.mode != "L":
+            img = img.convert("L")
+        if apply_alpha and layer.get("alpha", 1.0) < 1.0:
+            return Image.blend(composite, img, layer["alpha"])
+        result = composite.copy()
+        result.paste(img, (0, 0), img if img.mode == "RGBA" else None)
+        return result
+
+# ---------------------------- 
+# 派生平面缓存
+# ---------------------------- 
+class PlaneCache:
+    """LRU cache of planes derived from images, bounded by budget_mb.
+
+    A plane is a read-only array computed from a source image at a given
+    size: "pixels" (the image scaled to that size), "gray" or "lab". Layer
+    images are keyed on identity and content version, so an edit (which bumps
+    the version or replaces the image) simply misses, and the entries of an
+    image go away with it. Other sources, such as an imported file, are cached
+    through get() under a key that changes with their content.
+
+    It may be used from the stripe workers of a StripePool: lookups and
+    builds hold a lock, so a plane wanted by several stripes at once is
+    built a single time. With a pool, gray and LAB planes are converted
+    stripe by stripe on it.
+    """
+
+    def __init__(self, budget_mb=PLANE_CACHE_BUDGET_MB, pool=None):
+        self._entries = collections.OrderedDict()
+        self._sources = {}
+        self._lock = threading.RLock()
+        self._forgotten = collections.deque()
+        self.pool = pool
+        self.nbytes = 0
+        self.set_budget(budget_mb)
+
+    def set_budget(self, budget_mb):
+        with self._lock:
+            self.budget_bytes = int(budget_mb * 1024 * 1024)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def plane(self, img, version, kind, size):
+        """The kind plane of img, at the given layer version, scaled to size."""
+        if kind == "pixels" and img.size == size and not isinstance(img, PackedMask):
+            return image_array(img)
+        if kind == "gray" and img.mode != "RGB":
+            return self.plane(img, version, "pixels", size)
+        return self.derived(img, version, (kind, size), lambda: self._build_plane(img, version, kind, size))
+
+    def peek(self, img, version, kind, size):
+        """The kind plane of img if it is available without building or copying anything, else None."""
+        if kind == "pixels" and img.size == size and not isinstance(img, PackedMask):
+            return pixel_buffer(img)
+        if kind == "gray" and img.mode != "RGB":
+            return self.peek(img, version, "pixels", size)
+        with self._lock:
+            return self._lookup((id(img), version, (kind, size)), img)
+
+    def _build_plane(self, img, version, kind, size):
+        if kind == "pixels":
+            return np.asarray(img.resize(size, Image.Resampling.LANCZOS) if img.size != size else img)
+        pixels = self.plane(img, version, "pixels", size)
+        return self.convert(pixels, cv2.COLOR_RGB2LAB if kind == "lab" else cv2.COLOR_RGB2GRAY)
+
+    def convert(self, pixels, code):
+        """cv2.cvtColor of an RGB array, stripe by stripe on the pool when there is one."""
+        if self.pool is None or self.pool.workers == 1:
+            return cv2.cvtColor(np.ascontiguousarray(pixels), code)
+        out = np.empty(pixels.shape[:2] + ((3,) if code == cv2.COLOR_RGB2LAB else ()), dtype=np.uint8)
+        return self.pool.fill_rows(out, lambda y0, y1: cv2.cvtColor(np.ascontiguousarray(pixels[y0:y1]), code))
+
+    def derived(self, img, version, name, build):
+        """Cached build() result for img at the given layer version, stored under the hashable name."""
+        key = (id(img), version, name)
+        with self._lock:
+            arr = self._lookup(key, img)
+            if arr is None:
+                arr = build()
+                # 同一图像的旧版本结果已不可能再命中
+                for old in [k for k in self._entries if k[0] == key[0] and k[2:] == key[2:]]:
+                    self._discard(old)
+                self._store(key, self._source_ref(img), arr)
+            return arr
+
+    def get(self, key, build):
+        """Cached build() result for a hashable key that changes whenever the source does."""
+        with self._lock:
+            arr = self._lookup(key, None)
+            if arr is None:
+                arr = build()
+                self._store(key, None, arr)
+            return arr
+
+    def replace_image(self, old, new):
+        """Carry the planes of old over to new (same pixels, e.g. packed and unpacked forms)."""
+        with self._lock:
+            ref = self._sources.get(id(old))
+            if ref is None or ref() is not old:
+                return
+            for key in [k for k in self._entries if k[0] == id(old)]:
+                arr = self._entries.pop(key)[1]
+                self.nbytes -= arr.nbytes
+                self._store((id(new),) + key[1:], self._source_ref(new), arr)
+
+    def _lookup(self, key, img):
+        self._drop_forgotten()
+        entry = self._entries.get(key)
+        if entry is None or (img is not None and entry[0]() is not img):
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _source_ref(self, img):
+        ref = self._sources.get(id(img))
+        if ref is None or ref() is not img:
+            ref = weakref.ref(img, lambda _, key=id(img): self._forget(key))
+            self._sources[id(img)] = ref
+        return ref
+
+    def _forget(self, source_id):
+        self._sources.pop(source_id, None)
+        self._forgotten.append(source_id)
+        # 弱引用回调可能在任意线程触发，不能等待锁；锁被占用时留到下次查找再清除
+        if self._lock.acquire(blocking=False):
+            try:
+                self._drop_forgotten()
+            finally:
+                self._lock.release()
+
+    def _drop_forgotten(self):
+        while self._forgotten:
+            source_id = self._forgotten.popleft()
+            for key in [k for k in self._entries if k[0] == source_id]:
+                self._discard(key)
+
+    def _store(self, key, ref, arr):
+        if arr.nbytes > self.budget_bytes:
+            return
+        arr.setflags(write=False)
+        self._discard(key)
+        self._entries[key] = (ref, arr)
+        self.nbytes += arr.nbytes
+        self._evict()
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1].nbytes
+
+    def _evict(self):
+        while self.nbytes > self.budget_bytes and self._entries:
+            self._discard(next(iter(self._entries)))
+
+def histogram_table(chunks, channels, bin_width=1):
+    """Summed-area table of the histogram of uint8 pixel chunks with the given number of channels.
+
+    Each channel is split into 256 // bin_width bins. Entry [i, j, ...] of
+    the table is the number of pixels whose channels fall below bins i, j,
+    ..., so counting the pixels inside any box takes a fixed number of lookups.
+    """
+    bins = 256 // bin_width
+    shift = bin_width.bit_length() - 1
+    counts = np.zeros(bins ** channels, dtype=np.int64)
+    for chunk in chunks:
+        values = np.asarray(chunk).reshape(-1, channels)
+        index = (values[:, 0] >> shift).astype(np.int32)
+        for c in range(1, channels):
+            index *= bins
+            index += values[:, c] >> shift
+        counts += np.bincount(index, minlength=bins ** channels)
+    table = np.zeros((bins + 1,) * channels, dtype=np.int64)
+    table[(slice(1, None),) * channels] = counts.reshape((bins,) * channels)
+    for axis in range(channels):
+        np.cumsum(table, axis=axis, out=table)
+    return table
+
+def histogram_count(table, lower, upper):
+    """Pixels whose channels all lie in [lower, upper] (inclusive), in constant time from a histogram_table().
+
+    Exact when lower and upper + 1 fall on bin boundaries; inside a bin the
+    pixels are taken to be spread evenly, so the count is an estimate.
+    """
+    channels = table.ndim
+    bins = table.shape[0] - 1
+    bin_width = 256 // bins
+    lower = np.broadcast_to(np.asarray(lower, dtype=np.float64), (channels,))
+    upper = np.broadcast_to(np.asarray(upper, dtype=np.float64), (channels,))
+    ends = (np.clip(lower, 0, 256) / bin_width, np.clip(upper + 1, 0, 256) / bin_width)
+    total = 0.0
+    for corner in itertools.product((0, 1), repeat=channels):
+        point = [ends[c][axis] for axis, c in enumerate(corner)]
+        sign = -1 if (channels - sum(corner)) % 2 else 1
+        # 对汇总表做多线性插值
+        base = [min(int(x), bins - 1) for x in point]
+        frac = [x - b for x, b in zip(point, base)]
+        value = 0.0
+        for offset in itertools.product((0, 1), repeat=channels):
+            weight = 1.0
+            for f, o in zip(frac, offset):
+                weight *= f if o else 1.0 - f
+            if weight:
+                value += weight * table[tuple(b + o for b, o in zip(base, offset))]
+        total += sign * value
+    return max(0, int(round(total)))
+
+# ---------------------------- 
+# 并行分条处理
+# ---------------------------- 
+def attach_shared(spec):
+    """Open a shared-memory array described by a (name, shape, dtype) spec; returns (block, array).
+
+    Drop the array before calling block.close().
+    """
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def lab_in_range_stripe(src, dst, rows, lower, upper):
+    """Process-pool kernel: cv2.inRange of the LAB form of rows y0:y1 of the shared RGB array src, into dst."""
+    src_block, rgb = attach_shared(src)
+    dst_block, mask = attach_shared(dst)
+    try:
+        y0, y1 = rows
+        mask[y0:y1] = cv2.inRange(cv2.cvtColor(rgb[y0:y1], cv2.COLOR_RGB2LAB), lower, upper)
+    finally:
+        del rgb, mask
+        src_block.close()
+        dst_block.close()
+
+class StripePool:
+    """Runs per-pixel work on horizontal stripes of a frame with several workers.
+
+    map() hands the stripes to a thread pool. NumPy, OpenCV and PIL release
+    the GIL in their pixel loops, so stripes of an in-memory frame are really
+    processed in parallel. run_shared() sends a module-level kernel over the
+    stripes of a very large array to a process pool instead, with input and
+    output passed through multiprocessing.shared_memory.
+
+    Stripes never overlap and the work done on them is per pixel, so the
+    results are bit-identical to a serial run. With one worker, and inside
+    a stripe that is already running on the pool, everything runs inline.
+    The pools are started on first use and kept until the worker count
+    changes. A pool replaced while calls on other threads are still using it
+    is shut down only when the last of them returns.
+    """
+
+    def __init__(self, workers=DEFAULT_PARALLEL_WORKERS):
+        self._threads = None
+        self._processes = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._users = {}  # 执行器 -> 正在使用它的调用数
+        self._retired = set()  # 已被替换、等待最后一个调用结束后关闭的执行器
+        self.set_workers(workers)
+
+    def set_workers(self, workers):
+        with self._lock:
+            self.workers = max(1, int(workers))
+            self._retire_pools()
+
+    def shutdown(self):
+        with self._lock:
+            self._retire_pools()
+
+    def _retire_pools(self):
+        for pool in (self._threads, self._processes):
+            if pool is None:
+                continue
+            if self._users.get(pool):
+                self._retired.add(pool)
+            else:
+                pool.shutdown(wait=False)
+        self._threads = self._processes = None
+
+    def _acquire(self, processes=False):
+        """The thread (or process) pool for the current worker count, started if needed; pair with _release()."""
+        with self._lock:
+            if processes:
+                if self._processes is None:
+                    # 以 spawn 方式启动，子进程不继承 Tk 等主进程状态
+                    self._processes = concurrent.futures.ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context("spawn"))
+                pool = self._processes
+            else:
+                if self._threads is None:
+                    self._threads = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="stripe")
+                pool = self._threads
+            self._users[pool] = self._users.get(pool, 0) + 1
+            return pool
+
+    def _release(self, pool):
+        with self._lock:
+            self._users[pool] -= 1
+            if self._users[pool]:
+                return
+            del self._users[pool]
+            if pool in self._retired:
+                self._retired.discard(pool)
+                pool.shutdown(wait=False)
+
+    def stripes(self, y0, y1):
+        """Rows y0:y1 split into about two stripes per worker of at least PARALLEL_MIN_STRIPE_ROWS rows, as (r0, r1) pairs.
+
+        A single worker gets the rows in one piece.
+        """
+        count = 1 if self.workers == 1 else max(1, min(2 * self.workers, (y1 - y0) // PARALLEL_MIN_STRIPE_ROWS))
+        bounds = [y0 + (y1 - y0) * i // count for i in range(count + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def map(self, fn, items):
+        """[fn(item) for item in items], with the calls spread over the thread pool."""
+        items = list(items)
+        if self.workers == 1 or len(items) < 2 or getattr(self._local, "inside", False):
+            return [fn(item) for item in items]
+
+        def run(item):
+            self._local.inside = True
+            return fn(item)
+        pool = self._acquire()
+        try:
+            return list(pool.map(run, items))
+        finally:
+            self._release(pool)
+
+    def fill_rows(self, out, fn):
+        """Set out[y0:y1] = fn(y0, y1) for the stripes of out in parallel; returns out."""
+        def run(rows):
+            out[rows[0]:rows[1]] = fn(*rows)
+        self.map(run, self.stripes(0, out.shape[0]))
+        return out
+
+    def run_shared(self, kernel, src, out_shape, args=(), out_dtype=np.uint8):
+        """Array of out_shape filled by kernel(src spec, out spec, (y0, y1), *args) for every stripe of src, on the process pool.
+
+        kernel must be a module-level function; it opens both arrays with
+        attach_shared(). Copying src into shared memory is the only extra
+        pass over the frame.
+        """
+        out_dtype = np.dtype(out_dtype)
+        src_block = shared_memory.SharedMemory(create=True, size=max(1, src.nbytes))
+        out_block = shared_memory.SharedMemory(create=True, size=max(1, math.prod(out_shape) * out_dtype.itemsize))
+        pool = None
+        try:
+            shared = np.ndarray(src.shape, dtype=src.dtype, buffer=src_block.buf)
+            shared[...] = src
+            del shared
+            pool = self._acquire(processes=True)
+            src_spec = (src_block.name, src.shape, src.dtype.str)
+            out_spec = (out_block.name, tuple(out_shape), out_dtype.str)
+            futures = [pool.submit(kernel, src_spec, out_spec, rows, *args)
+                       for rows in self.stripes(0, src.shape[0])]
+            for future in futures:
+                future.result()
+            shared = np.ndarray(out_shape, dtype=out_dtype, buffer=out_block.buf)
+            result = shared.copy()
+            del shared
+            return result
+        finally:
+            if pool is not None:
+                self._release(pool)
+            for block in (src_block, out_block):
+                block.close()
+                block.unlink()
+
+# ---------------------------- 
+# 撤销历史
+# ---------------------------- 
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class SpillFile:
+    """Temporary file holding spilled history tiles; removed once no tile refers to it."""
+
+    def __init__(self, directory, chunks):
+        fd, self.path = tempfile.mkstemp(suffix=".bin", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        weakref.finalize(self, _remove_quietly, self.path)
+
+    def read(self, offset, length):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+class HistoryTile:
+    """One HISTORY_TILE_SIZE block of a layer snapshot.
+
+    Held raw while recent, then zlib-compressed (binary blocks are bit-packed
+    first) and possibly moved to a SpillFile. Tiles are immutable and shared
+    by every snapshot in which the block did not change. uniform holds the
+    pixel bytes of a tile filled with a single colour, None otherwise.
+    """
+
+    __slots__ = ("shape", "binary", "raw", "data", "spill", "uniform", "__weakref__")
+
+    def __init__(self, arr, uniform=None):
+        self.shape = arr.shape
+        self.uniform = uniform
+        self.binary = arr.ndim == 2 and np.count_nonzero(arr == 0) + np.count_nonzero(arr == 255) == arr.size
+        self.raw = arr
+        self.data = None
+        self.spill = None
+
+    @property
+    def memory_bytes(self):
+        if self.raw is not None:
+            return self.raw.nbytes
+        return len(self.data) if self.data is not None else 0
+
+    @property
+    def disk_bytes(self):
+        return self.spill[2] if self.spill is not None else 0
+
+    def compress(self):
+        if self.raw is None:
+            return
+        arr = self.raw
+        self.data = zlib.compress((np.packbits(arr == 255) if self.binary else arr).tobytes(), 1)
+        self.raw = None
+
+    def array(self):
+        """Pixel block as a read-only array, decompressing (without caching) if needed."""
+        if self.raw is not None:
+            return self.raw
+        data = self.data if self.data is not None else self.spill[0].read(self.spill[1], self.spill[2])
+        raw = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+        if self.binary:
+            h, w = self.shape
+            return np.unpackbits(raw, count=w * h).reshape(h, w) * np.uint8(255)
+        return raw.reshape(self.shape)
+
+class LayerSnapshot:
+    """Immutable tiled copy of one layer image, as stored in the history.
+
+    capture() compares the image with the previous snapshot of the same layer
+    block by block (only inside the edited rectangle when one is known) and
+    shares every unchanged tile, so an entry after a local edit costs a few
+    tiles rather than a whole layer. Blocks of a single colour (blank areas,
+    filled regions) share one tile per shape and colour from the
+    uniform_tiles map passed in (the history's), so the first snapshot of a
+    mostly blank layer is cheap too. patch() writes back only the tiles that
+    differ from another snapshot of the same lineage.
+    """
+
+    _lineages = itertools.count(1)
+
+    def __init__(self, mode, size, tiles, lineage):
+        self.mode = mode
+        self.size = size
+        # 超大图层加大块边长，使每个快照的块数不超过 HISTORY_MAX_TILES
+        self.tile = HISTORY_TILE_SIZE
+        while -(-size[0] // self.tile) * -(-size[1] // self.tile) > HISTORY_MAX_TILES:
+            self.tile *= 2
+        self.tiles = tiles
+        self.lineage = lineage
+        self._source = None
+        self._version = None
+        self._binary = None
+
+    @property
+    def binary(self):
+        """True if every pixel is 0 or 255, i.e. the layer can be stored bit-packed."""
+        if self._binary is None:
+            self._binary = self.mode == "L" and all(tile.binary for tile in self.tiles)
+        return self._binary
+
+    def tracks(self, img, version):
+        """True if img, at the given layer version, is known to hold exactly this snapshot."""
+        return self._source is not None and self._source() is img and self._version == version
+
+    def attach(self, img, version):
+        self._source = weakref.ref(img)
+        self._version = version
+
+    def source_is(self, img):
+        return self._source is not None and self._source() is img
+
+    def compatible(self, other):
+        return other is not None and other.size == self.size and other.mode == self.mode
+
+    def _grid(self):
+        t = self.tile
+        return -(-self.size[0] // t), -(-self.size[1] // t)
+
+    def tile_rect(self, k):
+        t = self.tile
+        cols, _ = self._grid()
+        x0, y0 = (k % cols) * t, (k // cols) * t
+        return (x0, y0, min(self.size[0], x0 + t), min(self.size[1], y0 + t))
+
+    @staticmethod
+    def _uniform_tile(uniform_tiles, shape, pixel):
+        """Tile of the given shape filled with pixel (a scalar or a colour array), shared through uniform_tiles."""
+        pixel = np.asarray(pixel, dtype=np.uint8).tobytes()
+        tile = uniform_tiles.get((shape, pixel))
+        if tile is None:
+            arr = np.broadcast_to(np.frombuffer(pixel, dtype=np.uint8), shape[:2] + (len(pixel),))
+            tile = uniform_tiles[shape, pixel] = HistoryTile(arr.reshape(shape).copy(), pixel)
+        return tile
+
+    @classmethod
+    def _blank_tile(cls, uniform_tiles, rect, mode):
+        """All-white tile for the blank areas of TiledImage layers."""
+        shape = (rect[3] - rect[1], rect[2] - rect[0]) + (() if mode == "L" else (3,))
+        return cls._uniform_tile(uniform_tiles, shape, 255 if mode == "L" else (255, 255, 255))
+
+    @staticmethod
+    def _is_blank(tile):
+        return tile.uniform is not None and tile.uniform == b"\xff" * len(tile.uniform)
+
+    @staticmethod
+    def _uniform_blocks(band, t):
+        """For each block of width t across band, whether all its pixels equal its top-left pixel."""
+        ref = np.repeat(band[:1, ::t], t, axis=1)[:, :band.shape[1]]
+        same = band == ref
+        if same.ndim == 3:
+            same = same.all(axis=2)
+        return np.logical_and.reduceat(same.all(axis=0), np.arange(0, band.shape[1], t))
+
+    @classmethod
+    def capture(cls, img, version, previous=None, rect=None, uniform_tiles=None):
+        if uniform_tiles is None:
+            uniform_tiles = {}
+        snap = cls(img.mode, img.size, None, None)
+        t = snap.tile
+        cols, rows = snap._grid()
+        if not snap.compatible(previous):
+            previous, rect = None, None
+        tiles = list(previous.tiles) if previous is not None else [None] * (cols * rows)
+        snap.lineage = previous.lineage if previous is not None else next(cls._lineages)
+        if rect is None:
+            tx0, ty0, tx1, ty1 = 0, 0, cols, rows
+        else:
+            rect = clip_rect(rect, img.size)
+            tx0, ty0, tx1, ty1 = (0, 0, 0, 0) if rect is None else (
+                rect[0] // t, rect[1] // t, -(-rect[2] // t), -(-rect[3] // t))
+        ox = tx0 * t
+        for ty in range(ty0, ty1):
+            band = None  # 按块行读取，避免一次复制整幅（可能极大的）区域
+            for tx in range(tx0, tx1):
+                k = ty * cols + tx
+                x0, y0, x1, y1 = snap.tile_rect(k)
+                if isinstance(img, TiledImage) and img.is_blank((x0, y0, x1, y1)):
+                    tiles[k] = cls._blank_tile(uniform_tiles, (x0, y0, x1, y1), img.mode)
+                    continue
+                if band is None:
+                    band = np.asarray(img.crop((ox, y0, min(img.width, tx1 * t), y1)))
+                    uniform = cls._uniform_blocks(band, t)
+                block = band[:, x0 - ox:x1 - ox]
+                if uniform[tx - tx0]:
+                    tiles[k] = cls._uniform_tile(uniform_tiles, block.shape, block[0, 0])
+                    continue
+                old = tiles[k]
+                if old is not None and np.array_equal(old.array(), block):
+                    continue
+                tiles[k] = HistoryTile(block.copy())
+        snap.tiles = tiles
+        snap.attach(img, version)
+        return snap
+
+    def to_image(self):
+        if use_tiled_storage(self.size):
+            img = TiledImage(self.size, self.mode)
+            for k, tile in enumerate(self.tiles):
+                rect = self.tile_rect(k)
+                if not self._is_blank(tile):
+                    img.write(rect, tile.array())
+            return img
+        w, h = self.size
+        first = self.tiles[0].array()
+        arr = np.empty((h, w) + first.shape[2:], dtype=np.uint8)
+        for k, tile in enumerate(self.tiles):
+            x0, y0, x1, y1 = self.tile_rect(k)
+            arr[y0:y1, x0:x1] = tile.array()
+        return Image.fromarray(arr)
+
+    def patch(self, img, current):
+        """Write into img (which holds current) the tiles that differ from current; returns the touched rect.
+
+        img is either a PIL image or the pixel array of an image_view().
+        """
+        rect = None
+        for k, (tile, cur) in enumerate(zip(self.tiles, current.tiles)):
+            if tile is cur:
+                continue
+            x0, y0, x1, y1 = self.tile_rect(k)
+            if isinstance(img, np.ndarray):
+                img[y0:y1, x0:x1] = tile.array()
+            else:
+                img.paste(Image.fromarray(tile.array()), (x0, y0))
+            rect = union_rect(rect, (x0, y0, x1, y1))
+        return rect
+
+class HistoryStore:
+    """Undo/redo stacks bounded by memory rather than by entry count.
+
+    Entries are (layers, current_layer_index) where each layer's "image" is a
+    LayerSnapshot; tiles are shared between entries. When the unique tiles
+    exceed budget_mb, the tiles reachable from the oldest entries are
+    compressed, then spilled to a temporary directory, one file per snapshot.
+    Tiles introduced by the keep_recent newest undo and redo entries stay
+    uncompressed. Entries are dropped only when spilled data exceeds the disk
+    budget. Compressed tiles are decoded transparently when read.
+
+    Memory and disk usage are kept as running totals: snapshots and tiles are
+    reference-counted as entries come and go, so a push costs the layers that
+    changed rather than the length of the history. Single-colour tiles are
+    shared through uniform_tiles, which belongs to this history alone, so
+    compressing or spilling them never touches another document's history.
+    """
+
+    def __init__(self, budget_mb=DEFAULT_HISTORY_BUDGET_MB, keep_recent=HISTORY_KEEP_RECENT,
+                 disk_budget_mb=None):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.keep_recent = keep_recent
+        self.set_budget(budget_mb, disk_budget_mb)
+        self._spill_dir = None
+        self._snapshots = {}  # id -> [快照, 引用它的条目数]
+        self._tile_refs = {}  # id -> [图块, 引用它的快照数, 计入的内存字节, 计入的磁盘字节]
+        self.uniform_tiles = {}  # (形状, 像素字节) -> 单色图块，供 LayerSnapshot.capture 共享
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+
+    def set_budget(self, budget_mb, disk_budget_mb=None):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        if disk_budget_mb is None:
+            disk_budget_mb = budget_mb * HISTORY_DISK_BUDGET_FACTOR
+        self.disk_budget_bytes = int(disk_budget_mb * 1024 * 1024)
+
+    def entries(self):
+        return itertools.chain(self.undo_stack, self.redo_stack)
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self._snapshots.clear()
+        self._tile_refs.clear()
+        self.uniform_tiles.clear()
+        self.memory_bytes = self.disk_bytes = 0
+
+    def push(self, state, current_layer_index):
+        self._retain(state)
+        self.undo_stack.append((state, current_layer_index))
+        for entry in self.redo_stack:
+            self._release(entry[0])
+        self.redo_stack.clear()
+        self.enforce_budget()
+
+    def pop_undo(self, current_state, current_layer_index):
+        """Pop the newest undo entry and park the current state on the redo stack."""
+        if not self.undo_stack:
+            return None
+        self._retain(current_state)
+        entry = self.undo_stack.pop()
+        self.redo_stack.append((current_state, current_layer_index))
+        self._release(entry[0])
+        self.enforce_budget()
+        return entry
+
+    def pop_redo(self, current_state, current_layer_index):
+        if not self.redo_stack:
+            return None
+        self._retain(current_state)
+        entry = self.redo_stack.pop()
+        self.undo_stack.append((current_state, current_layer_index))
+        self._release(entry[0])
+        self.enforce_budget()
+        return entry
+
+    def _retain(self, state):
+        for saved in state:
+            snap = saved["image"]
+            if snap is None:
+                continue
+            ref = self._snapshots.get(id(snap))
+            if ref is None:
+                ref = self._snapshots[id(snap)] = [snap, 0]
+                for tile in snap.tiles:
+                    tile_ref = self._tile_refs.get(id(tile))
+                    if tile_ref is None:
+                        tile_ref = self._tile_refs[id(tile)] = [tile, 0, tile.memory_bytes, tile.disk_bytes]
+                        self.memory_bytes += tile_ref[2]
+                        self.disk_bytes += tile_ref[3]
+                    tile_ref[1] += 1
+            ref[1] += 1
+
+    def _release(self, state):
+        for saved in state:
+            snap = saved["image"]
+            if snap is None:
+                continue
+            ref = self._snapshots[id(snap)]
+            ref[1] -= 1
+            if ref[1]:
+                continue
+            del self._snapshots[id(snap)]
+            for tile in snap.tiles:
+                tile_ref = self._tile_refs[id(tile)]
+                tile_ref[1] -= 1
+                if not tile_ref[1]:
+                    del self._tile_refs[id(tile)]
+                    self.memory_bytes -= tile_ref[2]
+                    self.disk_bytes -= tile_ref[3]
+                    if tile.uniform is not None and self.uniform_tiles.get((tile.shape, tile.uniform)) is tile:
+                        # 不再被历史引用的单色图块移出共享表，使其不随用过的颜色无限增长
+                        del self.uniform_tiles[tile.shape, tile.uniform]
+
+    def _recount(self, tile):
+        """Update the running totals after tile was compressed or spilled."""
+        tile_ref = self._tile_refs[id(tile)]
+        memory, disk = tile.memory_bytes, tile.disk_bytes
+        self.memory_bytes += memory - tile_ref[2]
+        self.disk_bytes += disk - tile_ref[3]
+        tile_ref[2:] = memory, disk
+
+    @staticmethod
+    def _tiles(entries):
+        """Unique tiles reachable from entries, in entry order."""
+        seen = {}
+        for state, _ in entries:
+            for saved in state:
+                if saved["image"] is not None:
+                    for tile in saved["image"].tiles:
+                        seen.setdefault(id(tile), tile)
+        return list(seen.values())
+
+    def usage(self):
+        """(memory bytes, disk bytes) held by the history."""
+        return self.memory_bytes, self.disk_bytes
+
+    def _split_by_age(self):
+        """(recent, older): the protected newest entries, and the rest farthest from the current state first."""
+        keep = self.keep_recent
+        if not keep:
+            return [], self.undo_stack + self.redo_stack
+        return (self.undo_stack[-keep:] + self.redo_stack[-keep:],
+                self.undo_stack[:-keep] + self.redo_stack[:-keep])
+
+    def enforce_budget(self):
+        if self.memory_bytes > self.budget_bytes:
+            _, older = self._split_by_age()
+            # 先压缩旧历史可达的图块（最近条目新引入的图块不在其中）
+            for tile in self._tiles(older):
+                if self.memory_bytes <= self.budget_bytes:
+                    break
+                if tile.raw is not None:
+                    tile.compress()
+                    self._recount(tile)
+            # 仍超出预算则按快照把压缩数据写入临时目录
+            for state, _ in older:
+                for saved in state:
+                    if self.memory_bytes <= self.budget_bytes or saved["image"] is None:
+                        continue
+                    batch = [t for t in saved["image"].tiles if t.data is not None]
+                    if batch:
+                        self._spill(batch)
+        while self.disk_bytes > self.disk_budget_bytes and len(self.undo_stack) > self.keep_recent:
+            self._release(self.undo_stack.pop(0)[0])
+
+    def _spill(self, tiles):
+        tiles = list({id(t): t for t in tiles}.values())
+        spill = SpillFile(self._spill_directory(), [t.data for t in tiles])
+        offset = 0
+        for tile in tiles:
+            length = len(tile.data)
+            tile.spill = (spill, offset, length)
+            tile.data = None
+            offset += length
+            self._recount(tile)
+
+    def _spill_directory(self):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="mask_editor_history_")
+            weakref.finalize(self, shutil.rmtree, self._spill_dir, True)
+        return self._spill_dir
+
+# ---------------------------- 
+# 文档模型
+# ---------------------------- 
+def parse_resolution(text):
+    """(width, height) parsed from "宽×高" or "WxH" text; raises ValueError with a message for the user."""
+    text = text.strip()
+    if not text:
+        raise ValueError("请输入分辨率")
+    parts = text.replace("×", "x").split("x")
+    if len(parts) != 2:
+        raise ValueError("格式错误，请输入 宽×高")
+    width, height = map(int, parts)
+    if width <= 0 or height <= 0:
+        raise ValueError("分辨率必须为正整数")
+    return (width, height)
+
+def parse_lab_threshold(text):
+    """(Lmin, Lmax, Amin, Amax, Bmin, Bmax) parsed from comma-separated text, or None if empty or invalid."""
+    if not text:
+        return None
+    parts = [p.strip() for p in text.replace("，", ",").split(",") if p.strip() != ""]
+    if len(parts) != 6:
+        return None
+    try:
+        Lmin, Lmax, Amin, Amax, Bmin, Bmax = map(int, parts)
+        if not (0 <= Lmin <= Lmax <= 255 and -128 <= Amin <= Amax <= 127 and -128 <= Bmin <= Bmax <= 127):
+            return None
+        return (Lmin, Lmax, Amin, Amax, Bmin, Bmax)
+    except:
+        return None
+
+def parse_gray_threshold(text):
+    """(min, max) parsed from comma-separated text, or (None, None) if empty or invalid."""
+    if not text:
+        return (None, None)
+    parts = [p.strip() for p in text.replace("，", ",").split(",") if p.strip() != ""]
+    if len(parts) != 2:
+        return (None, None)
+    try:
+        return (int(parts[0]), int(parts[1]))
+    except:
+        return (None, None)
+
+def fit_image(img, size, crop=None, pad=False):
+    """img brought to size for a new layer: crop (a box) is cut out first; pad centres a smaller image on white instead of scaling it."""
+    if crop is not None:
+        img = img.crop(crop)
+    if pad:
+        new = Image.new(img.mode, size, 255 if img.mode == "L" else (255, 255, 255))
+        new.paste(img, ((size[0] - img.width) // 2, (size[1] - img.height) // 2))
+        return new
+    if img.size != tuple(size):
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    return img
+
+class MaskDocument:
+    """The layers being edited, with their settings, edit operations, history and file I/O.
+
+    Layers are dicts with "name", "image", "visible", "applied", "alpha" and
+    "hidden" keys; "image" is a PIL Image, a PackedMask or a TiledImage at
+    target_resolution. Operations that cannot run raise ValueError with a
+    message for the user. Nothing here needs Tk; MaskEditorApp displays a
+    document and turns user input into calls on it.
+    """
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, workers=DEFAULT_PARALLEL_WORKERS,
+                 history_budget_mb=DEFAULT_HISTORY_BUDGET_MB):
+        self.target_resolution = tuple(resolution)
+        self.custom_resolution = None  # 自定义分辨率，优先级高于默认
+        self.layers = [self._new_layer_dict("Layer 1", Image.new("L", self.target_resolution, 255))]
+        self.current_layer_index = 0
+        self.selected_region = None
+        self.copied_region = None
+        self.threshold_lab = DEFAULT_LAB
+        self.threshold_gray = DEFAULT_GRAY_BIN
+        self.auto_mask_gray_threshold = DEFAULT_AUTO_MASK_GRAY_THRESHOLD
+        self.auto_mask_lab_threshold = DEFAULT_AUTO_MASK_LAB_THRESHOLD
+        self.auto_mask_mode = DEFAULT_AUTO_MASK_MODE
+        self.auto_mask_votes = 1  # 投票模式下像素被选中所需的最少（加权）票数
+        self.compositor = LayerCompositor()
+        self.stripe_pool = StripePool(workers)
+        self.planes = PlaneCache(pool=self.stripe_pool)
+        self.history = HistoryStore(history_budget_mb)
+        self.pack_layers = True  # 空闲的黑白图层按 1 位/像素存储
+        self.record_history = True  # 关闭后编辑不再进入撤销历史（批处理不需要撤销）
+        self.edit_rect = None  # 自上次显示以来原地编辑过的区域
+
+    @staticmethod
+    def _new_layer_dict(name, img):
+        return {"name": name, "image": img, "visible": True, "applied": False, "alpha": 1.0, "hidden": False}
+
+    @property
+    def current_layer(self):
+        """The selected layer, or None when there is none."""
+        if 0 <= self.current_layer_index < len(self.layers):
+            return self.layers[self.current_layer_index]
+        return None
+
+    def is_tiled(self):
+        """True when some layer is a TiledImage, so composites are built region by region."""
+        return any(isinstance(layer["image"], TiledImage) for layer in self.layers)
+
+    # 图层
+
+    def new_canvas(self):
+        """Replace the layers with one white layer at the custom (or default) resolution."""
+        self.target_resolution = self.custom_resolution if self.custom_resolution else DEFAULT_RESOLUTION
+        self.layers = [self._new_layer_dict("Layer 1", new_layer_image(self.target_resolution))]
+        self.current_layer_index = 0
+        self.push_history()
+
+    def reset(self):
+        """Back to a single white layer with an empty history."""
+        self.target_resolution = self.custom_resolution if self.custom_resolution else DEFAULT_RESOLUTION
+        self.layers = [self._new_layer_dict("Layer 1", new_layer_image(self.target_resolution))]
+        self.current_layer_index = 0
+        self.history.clear()
+        self.copied_region = None
+        self.selected_region = None
+
+    def set_resolution(self, size):
+        """Make size the custom resolution and resize every layer to it."""
+        self.custom_resolution = tuple(size)
+        self.target_resolution = self.custom_resolution
+        for layer in self.layers:
+            if layer["image"]:
+                layer["image"] = resize_layer_image(layer["image"], self.target_resolution)
+
+    def new_layer(self):
+        """Append a blank white layer and select it; returns it."""
+        layer = self._new_layer_dict(f"Layer {len(self.layers) + 1}", new_layer_image(self.target_resolution))
+        self.layers.append(layer)
+        self.current_layer_index = len(self.layers) - 1
+        self.push_history()
+        return layer
+
+    def add_layer(self, img):
+        """Append a layer holding img (already at target_resolution) and select it; returns it."""
+        layer = self._new_layer_dict(f"Layer {len(self.layers) + 1}", to_layer_storage(img))
+        self.layers.append(layer)
+        self.current_layer_index = len(self.layers) - 1
+        self.push_history()
+        return layer
+
+    def delete_layer(self):
+        """Remove the current layer; returns it."""
+        if len(self.layers) <= 1:
+            raise ValueError("不能删除最后一个图层")
+        layer = self.layers.pop(self.current_layer_index)
+        self.current_layer_index = min(self.current_layer_index, len(self.layers) - 1)
+        self.push_history()
+        return layer
+
+    def sort_layers(self, names):
+        """Put the layers named in names first, in that order, followed by the others."""
+        new_layers = []
+        for name in names:
+            for layer in self.layers:
+                if layer["name"] == name:
+                    new_layers.append(layer)
+                    break
+        for layer in self.layers:
+            if layer["name"] not in names:
+                new_layers.append(layer)
+        self.layers = new_layers
+        self.current_layer_index = min(self.current_layer_index, len(self.layers) - 1)
+        self.push_history()
+
+    # 编辑
+
+    def layer_modified(self, layer, rect=None):
+        """Record an in-place edit of layer; rect limits recompositing, redisplay and the next history diff to that box."""
+        if rect is None:
+            touch_layer(layer)
+            rect = (0, 0) + layer["image"].size
+        else:
+            self.compositor.mark_dirty(layer, rect)
+        layer["history_dirty"] = union_rect(layer.get("history_dirty"), rect)
+        self.edit_rect = union_rect(self.edit_rect, rect)
+
+    def unpack_layer(self, layer):
+        """Turn a PackedMask layer back into an editable, buffer-backed "L" image with the same content."""
+        if isinstance(layer["image"], PackedMask):
+            self.layer_pixels(layer)
+
+    def layer_pixels(self, layer):
+        """Writable pixel array of an in-memory "L" layer, whose image is a zero-copy view of it; None otherwise.
+
+        The first call on a layer that is not buffer-backed yet (new, packed,
+        resized or rebuilt from history) copies its pixels once into a fresh
+        array and rebinds the layer to a view of it.
+        """
+        img = layer["image"]
+        if img.mode != "L" or isinstance(img, TiledImage):
+            return None
+        arr = pixel_buffer(img)
+        if arr is None:
+            arr = np.array(img)
+            self._rebind_image(layer, image_view(arr))
+        return arr
+
+    def _rebind_image(self, layer, img):
+        """Swap layer["image"] for img holding the same pixels, keeping compositor caches and history tracking."""
+        old = layer["image"]
+        self.compositor.replace_image(old, img)
+        self.planes.replace_image(old, img)
+        snap = layer.get("snapshot")
+        version = layer.get("version", 0)
+        if snap is not None and snap.tracks(old, version):
+            snap.attach(img, version)
+        layer["image"] = img
+
+    def paste_into_layer(self, layer, value, rect):
+        """Fill rect (inside the image) with a colour, or with an image of rect's size, in place and report the edit."""
+        arr = self.layer_pixels(layer)
+        x0, y0, x1, y1 = rect
+        if arr is not None:
+            arr[y0:y1, x0:x1] = np.asarray(value) if isinstance(value, Image.Image) else value
+        elif isinstance(value, Image.Image):
+            layer["image"].paste(value, (x0, y0))
+        else:
+            layer["image"].paste(value, rect)
+        self.layer_modified(layer, rect)
+
+    def copy_selection(self):
+        """Remember the selected region of the current layer for paste_copied()."""
+        layer = self.current_layer
+        if layer is None or not layer["image"] or self.selected_region is None:
+            raise ValueError("请先选择一个区域")
+        self.copied_region = layer["image"].crop(self.selected_region)
+
+    def paste_copied(self):
+        """Paste the copied region into the current layer at (0, 0)."""
+        layer = self.current_layer
+        if layer is None or not layer["image"] or self.copied_region is None:
+            raise ValueError("没有复制的区域可粘贴")
+        self.unpack_layer(layer)
+        new = layer["image"].copy()
+        new.paste(self.copied_region, (0, 0))
+        layer["image"] = new
+        self.push_history()
+
+    def delete_selection(self):
+        """Fill the selected region of the current layer with white and drop the selection."""
+        layer = self.current_layer
+        if layer is None or not layer["image"] or self.selected_region is None:
+            raise ValueError("请先选择一个区域")
+        sx1, sy1, sx2, sy2 = self.selected_region
+        fill_color = 255 if layer["image"].mode == "L" else (255, 255, 255)
+        rect = clip_rect((sx1, sy1, sx2 + 1, sy2 + 1), layer["image"].size)
+        if rect is not None:
+            self.paste_into_layer(layer, fill_color, rect)
+        self.push_history()
+        self.selected_region = None
+
+    # 自动掩码与阈值
+
+    def auto_mask(self):
+        """Clear the bottom layer's pixels selected by the auto-mask settings, inside the selection if any; returns that region or None."""
+        if len(self.layers) < 2:
+            raise ValueError("需要至少两个图层以执行自动掩码")
+        bottom_layer = self.layers[-1]
+        if not bottom_layer["image"]:
+            raise ValueError("底图层没有图像")
+
+        conditions = self._auto_mask_conditions(self.auto_mask_gray_threshold, self.auto_mask_lab_threshold)
+        if not conditions:
+            raise ValueError("没有可用的图层用于计算交集")
+
+        # 应用交集到倒数第一个图层（有选区时只处理选区）；内存图层按水平条带并行处理，分块图层按块行依次处理
+        w, h = self.target_resolution
+        roi = self._selection_roi((w, h))
+        x0, y0, x1, y1 = roi or (0, 0, w, h)
+        if bottom_layer["image"].mode != "L":
+            bottom_layer["image"] = bottom_layer["image"].convert("L")
+        bottom_img = bottom_layer["image"]
+        packed_bits = bottom_img.bits.copy() if isinstance(bottom_img, PackedMask) and bottom_img.size == (w, h) else None
+        pixels = self.layer_pixels(bottom_layer) if packed_bits is None else None
+
+        def apply(band):
+            r0, r1 = band
+            bits = self._auto_mask_region(conditions, (x0, r0, x1, r1))
+            if packed_bits is not None and (x0, x1) == (0, w):
+                packed_bits[r0:r1] &= ~bits
+                return
+            clear = np.unpackbits(bits, axis=1, count=x1 - x0).view(bool)
+            if packed_bits is not None:
+                # 选区左右边界不在字节边界上，只解包选区覆盖的字节
+                b0, b1 = x0 // 8, -(-x1 // 8)
+                cols = np.unpackbits(packed_bits[r0:r1, b0:b1], axis=1)
+                cols[:, x0 - b0 * 8:x1 - b0 * 8][clear] = 0
+                packed_bits[r0:r1, b0:b1] = np.packbits(cols, axis=1)
+            elif isinstance(bottom_img, TiledImage):
+                rows = bottom_img.read((x0, r0, x1, r1))
+                rows[clear] = 0
+                bottom_img.write((x0, r0, x1, r1), rows)
+            else:
+                pixels[r0:r1, x0:x1][clear] = 0
+
+        if self.is_tiled():
+            # 分块图层的块缓存不支持并发访问
+            for r0 in range(y0, y1, TILED_TILE_SIZE):
+                apply((r0, min(y1, r0 + TILED_TILE_SIZE)))
+        else:
+            if roi is None:
+                # 整帧处理时先建好可缓存的缩放与 LAB 平面（按条并行转换），各条带直接切片复用
+                for layer, kind, *_ in conditions:
+                    if kind == "lab" or layer["image"].size != (w, h):
+                        self.planes.plane(layer["image"], layer.get("version", 0), kind, (w, h))
+            self.stripe_pool.map(apply, self.stripe_pool.stripes(y0, y1))
+        if packed_bits is not None:
+            bottom_layer["image"] = PackedMask(bottom_img.size, packed_bits)
+        else:
+            self.layer_modified(bottom_layer, roi)
+        self.push_history()
+        return roi
+
+    def _auto_mask_conditions(self, gray_threshold, lab_threshold):
+        """Range tests of auto mask for the given thresholds, as (layer, plane kind, lower, upper) tuples."""
+        conditions = []
+        for layer in self.layers[:-1]:
+            img = layer["image"]
+            if not (img and layer["visible"]):
+                continue
+            if img.mode == "L":
+                # 灰度阈值非空时按灰度阈值处理；灰度与 LAB 阈值均为空时按二值化图处理（白色像素）
+                if gray_threshold is not None:
+                    conditions.append((layer, "pixels") + tuple(gray_threshold))
+                elif lab_threshold is None:
+                    conditions.append((layer, "pixels", 255, 255))
+            elif img.mode == "RGB" and lab_threshold is not None:
+                Lmin, Lmax, Amin, Amax, Bmin, Bmax = lab_threshold
+                lower = np.array([Lmin, Amin, Bmin], dtype=np.uint8)
+                upper = np.array([Lmax, Amax, Bmax], dtype=np.uint8)
+                conditions.append((layer, "lab", lower, upper))
+        return conditions
+
+    def _selection_roi(self, size):
+        """The selection clipped to an image of the given size, as the region of interest; None without a selection."""
+        if self.selected_region is None:
+            return None
+        return clip_rect(self.selected_region, size)
+
+    def _target_region(self, layer, box, kind="pixels", size=None):
+        """The box part of a layer's "pixels" or "lab" plane scaled to size, as a read-only array.
+
+        size defaults to target_resolution. Whole planes come from the plane
+        cache and so do parts of planes that are already cached; otherwise
+        only the box is read and converted. An in-memory layer of another
+        size is always resized as a whole (through the cache), so the result
+        does not depend on how a frame is split into stripes; a tiled layer
+        resizes just the box.
+        """
+        img = layer["image"]
+        w, h = size or self.target_resolution
+        x0, y0, x1, y1 = box
+        version = layer.get("version", 0)
+        if not isinstance(img, TiledImage):
+            if box == (0, 0, w, h):
+                return self.planes.plane(img, version, kind, (w, h))
+            cached = self.planes.peek(img, version, kind, (w, h))
+            if cached is not None:
+                return cached[y0:y1, x0:x1]
+            if img.size != (w, h):
+                region = self.planes.plane(img, version, "pixels", (w, h))[y0:y1, x0:x1]
+                if kind == "lab":
+                    region = cv2.cvtColor(np.ascontiguousarray(region), cv2.COLOR_RGB2LAB)
+                return region
+        if img.size != (w, h):
+            sx, sy = img.width / w, img.height / h
+            region = np.asarray(img.resize((x1 - x0, y1 - y0), Image.Resampling.LANCZOS,
+                                           box=(x0 * sx, y0 * sy, x1 * sx, y1 * sy)))
+        elif isinstance(img, TiledImage):
+            region = img.read(box)
+        else:
+            region = np.asarray(img.crop(box))
+        if kind == "lab":
+            region = cv2.cvtColor(np.ascontiguousarray(region), cv2.COLOR_RGB2LAB)
+        return region
+
+    def _auto_mask_region(self, conditions, box, size=None, combine=None):
+        """Pixels inside box selected by the auto-mask conditions, as np.packbits rows.
+
+        Every condition is an inclusive range test on a plane scaled to size
+        (target_resolution by default): gray and binary layers on their pixels,
+        RGB layers on LAB. combine is a (mode, votes) pair and defaults to
+        the auto_mask_mode / auto_mask_votes settings; see _auto_mask_votes()
+        for the union and vote modes.
+
+        For an intersection the tests write into one preallocated buffer that
+        is ANDed in place into the running 0/255 result, which is packed once
+        at the end; bit-packed layers tested against 255 are ANDed in by their
+        stored bits when box spans whole rows. Resized and LAB planes are
+        reused from the plane cache, so repeating the call with other
+        thresholds only re-runs the comparisons.
+        """
+        mode, votes = combine or (self.auto_mask_mode, self.auto_mask_votes)
+        if mode != "intersection":
+            return self._auto_mask_votes(conditions, box, size, mode, votes)
+        w, h = size or self.target_resolution
+        x0, y0, x1, y1 = box
+        packed = None
+        tests = []
+        for layer, kind, lower, upper in conditions:
+            img = layer["image"]
+            if isinstance(img, PackedMask) and img.size == (w, h) and (lower, upper) == (255, 255) and (x0, x1) == (0, w):
+                bits = img.bits[y0:y1]
+                packed = bits.copy() if packed is None else np.bitwise_and(packed, bits, out=packed)
+            else:
+                tests.append((layer, kind, lower, upper))
+        if not tests:
+            return packed
+
+        result = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+        scratch = np.empty_like(result)
+        for i, (layer, kind, lower, upper) in enumerate(tests):
+            arr = self._target_region(layer, box, kind, (w, h))
+            if i == 0:
+                cv2.inRange(arr, lower, upper, dst=result)
+            else:
+                cv2.inRange(arr, lower, upper, dst=scratch)
+                cv2.bitwise_and(result, scratch, dst=result)
+        bits = np.packbits(result, axis=1)
+        return bits if packed is None else np.bitwise_and(packed, bits, out=packed)
+
+    def _condition_bits(self, condition, box, size, scratch):
+        """Packed result of one auto-mask range test inside box; scratch is a uint8 buffer of the box's shape."""
+        layer, kind, lower, upper = condition
+        img = layer["image"]
+        w, h = size
+        x0, y0, x1, y1 = box
+        if isinstance(img, PackedMask) and img.size == (w, h) and (lower, upper) == (255, 255) and (x0, x1) == (0, w):
+            return img.bits[y0:y1]
+        cv2.inRange(self._target_region(layer, box, kind, size), lower, upper, dst=scratch)
+        return np.packbits(scratch, axis=1)
+
+    def _auto_mask_votes(self, conditions, box, size, mode, votes):
+        """Union or weighted-vote combination of the auto-mask conditions inside box, as np.packbits rows.
+
+        Each test is packed to bits right away. A union ORs them; a vote adds
+        every layer's "vote_weight" (1 by default) into a bit-sliced
+        BitCounter and selects the pixels with at least votes.
+        """
+        size = size or self.target_resolution
+        x0, y0, x1, y1 = box
+        scratch = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+        result = None
+        counter = BitCounter((y1 - y0, -(-(x1 - x0) // 8))) if mode == "vote" else None
+        weights = [layer_vote_weight(condition[0]) for condition in conditions] if counter is not None else None
+        for i, condition in enumerate(conditions):
+            bits = self._condition_bits(condition, box, size, scratch)
+            if counter is not None:
+                counter.add(bits, weights[i])
+            elif result is None:
+                result = bits.copy()
+            else:
+                np.bitwise_or(result, bits, out=result)
+        return counter.at_least(votes) if counter is not None else result
+
+    def _proxy_size(self, size):
+        """Size of the downsampled proxy used for live threshold previews."""
+        scale = min(1.0, PREVIEW_PROXY_SIZE / max(size))
+        return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+    def auto_mask_preview(self, gray_threshold, lab_threshold, combine=None):
+        """Auto-mask result for the given thresholds on a proxy of the bottom layer, or None if it cannot run."""
+        if len(self.layers) < 2 or not self.layers[-1]["image"]:
+            return None
+        conditions = self._auto_mask_conditions(gray_threshold, lab_threshold)
+        if not conditions:
+            return None
+        size = self._proxy_size(self.target_resolution)
+        bottom = self.layers[-1]
+        result = np.array(self.planes.plane(bottom["image"], bottom.get("version", 0), "gray", size))
+        bits = self._auto_mask_region(conditions, (0, 0) + size, size, combine)
+        result[np.unpackbits(bits, axis=1, count=size[0]).view(bool)] = 0
+        return Image.fromarray(result)
+
+    def build_preview_planes(self):
+        """Build the auto-mask proxy planes one layer per step (a generator), so the work can be spread over idle callbacks."""
+        size = self._proxy_size(self.target_resolution)
+        for i, layer in enumerate(self.layers):
+            img = layer["image"]
+            if not img:
+                continue
+            kind = "gray" if i == len(self.layers) - 1 else "lab" if img.mode == "RGB" else "pixels"
+            self.planes.plane(img, layer.get("version", 0), kind, size)
+            yield
+
+    def _layer_histogram(self, layer, kind, size=None):
+        """Histogram table of a layer's "pixels" (gray) or "lab" plane at size (target_resolution by default).
+
+        Built once per layer version (band by band on a tiled canvas) and kept
+        in the plane cache; LAB uses LAB_HISTOGRAM_BIN wide bins.
+        """
+        img = layer["image"]
+        w, h = size or self.target_resolution
+        channels, bin_width = (3, LAB_HISTOGRAM_BIN) if kind == "lab" else (1, 1)
+
+        def build():
+            step = TILED_TILE_SIZE if isinstance(img, TiledImage) else h
+            chunks = (self._target_region(layer, (0, y0, w, min(h, y0 + step)), kind, (w, h)) for y0 in range(0, h, step))
+            return histogram_table(chunks, channels, bin_width)
+
+        return self.planes.derived(img, layer.get("version", 0), ("histogram", kind, (w, h)), build)
+
+    def auto_mask_counts(self, gray_threshold, lab_threshold, combine=None):
+        """Lines describing how many pixels each auto-mask condition selects, and roughly their combination.
+
+        Per-layer counts come from the histogram tables; the combined result
+        is estimated from the preview proxy.
+        """
+        conditions = self._auto_mask_conditions(gray_threshold, lab_threshold)
+        if len(self.layers) < 2 or not conditions:
+            return []
+        w, h = self.target_resolution
+        total = w * h
+        lines = []
+        for layer, kind, lower, upper in conditions:
+            count = histogram_count(self._layer_histogram(layer, kind), lower, upper)
+            approx = "≈" if kind == "lab" else ""
+            lines.append(f"{layer['name']}：{approx}{count} 像素（{count / total:.1%}）")
+        size = self._proxy_size((w, h))
+        bits = self._auto_mask_region(conditions, (0, 0) + size, size, combine)
+        ones = int(np.unpackbits(bits, axis=1, count=size[0]).sum())
+        count = round(ones * total / (size[0] * size[1]))
+        mode = (combine or (self.auto_mask_mode,))[0]
+        lines.append(f"{AUTO_MASK_MODES[mode]}：≈{count} 像素（{count / total:.1%}）")
+        return lines
+
+    def binarize_counts(self, lab_threshold, gray_threshold):
+        """Line describing how many pixels of the current layer the import thresholds select."""
+        layer = self.current_layer
+        if layer is None or not layer["image"]:
+            return []
+        img = layer["image"]
+        total = img.width * img.height
+        if img.mode == "RGB":
+            Lmin, Lmax, Amin, Amax, Bmin, Bmax = lab_threshold
+            count = histogram_count(self._layer_histogram(layer, "lab", img.size), (Lmin, Amin, Bmin), (Lmax, Amax, Bmax))
+            return [f"{layer['name']}：≈{count} 像素（{count / total:.1%}）"]
+        count = histogram_count(self._layer_histogram(layer, "pixels", img.size), *gray_threshold)
+        return [f"{layer['name']}：{count} 像素（{count / total:.1%}）"]
+
+    def binarize_preview(self, lab_threshold, gray_threshold):
+        """The current layer binarized like an import with these thresholds, on a proxy; None without a layer."""
+        layer = self.current_layer
+        if layer is None or not layer["image"]:
+            return None
+        img = layer["image"]
+        size = self._proxy_size(img.size)
+        if img.mode == "RGB":
+            Lmin, Lmax, Amin, Amax, Bmin, Bmax = lab_threshold
+            lab = self.planes.plane(img, layer.get("version", 0), "lab", size)
+            mask = cv2.inRange(lab, np.array([Lmin, Amin, Bmin], dtype=np.uint8), np.array([Lmax, Amax, Bmax], dtype=np.uint8))
+        else:
+            gmin, gmax = gray_threshold
+            mask = cv2.inRange(self.planes.plane(img, layer.get("version", 0), "gray", size), gmin, gmax)
+        return Image.fromarray(mask)
+
+    def mask_invert(self):
+        """Swap black and white pixels of the current layer (inside the selection if any); returns that region or None."""
+        if self.current_layer is None or not self.current_layer["image"]:
+            raise ValueError("当前图层没有图像")
+        layer = self.current_layer
+        if layer["image"].mode != "L":
+            layer["image"] = layer["image"].convert("L")
+        # 原地反转（有选区时只处理选区），仅交换 0 与 255，其余灰度值保持不变
+        img = layer["image"]
+        roi = self._selection_roi(img.size)
+        x0, y0, x1, y1 = roi or (0, 0) + img.size
+        if isinstance(img, TiledImage):
+            for r0 in range(y0, y1, TILED_TILE_SIZE):
+                box = (x0, r0, x1, min(y1, r0 + TILED_TILE_SIZE))
+                rows = img.read(box)
+                np.subtract(255, rows, out=rows, where=(rows == 0) | (rows == 255))
+                img.write(box, rows)
+        else:
+            arr = self.layer_pixels(layer)
+            def invert(band):
+                rows = arr[band[0]:band[1], x0:x1]
+                np.subtract(255, rows, out=rows, where=(rows == 0) | (rows == 255))
+            self.stripe_pool.map(invert, self.stripe_pool.stripes(y0, y1))
+        self.layer_modified(layer, roi)
+        self.push_history()
+        return roi
+
+    def binarize_layer(self):
+        """Binarize the current layer with the import thresholds, inside the selection when there is one; returns that region or None.
+
+        RGB layers are tested against threshold_lab, others against
+        threshold_gray. Without a selection an RGB layer becomes a black and
+        white "L" layer, as an import in binarization mode would.
+        """
+        if self.current_layer is None or not self.current_layer["image"]:
+            raise ValueError("当前图层没有图像")
+        layer = self.current_layer
+        if layer["image"].mode not in ("L", "RGB"):
+            layer["image"] = layer["image"].convert("L")
+        self.unpack_layer(layer)
+        img = layer["image"]
+        roi = self._selection_roi(img.size)
+        x0, y0, x1, y1 = roi or (0, 0) + img.size
+        rgb = img.mode == "RGB"
+        if rgb:
+            Lmin, Lmax, Amin, Amax, Bmin, Bmax = self.threshold_lab
+            lower = np.array([Lmin, Amin, Bmin], dtype=np.uint8)
+            upper = np.array([Lmax, Amax, Bmax], dtype=np.uint8)
+        else:
+            lower, upper = self.threshold_gray
+        def binarize(r0, r1):
+            region = np.asarray(img.crop((x0, r0, x1, r1)))
+            if rgb:
+                region = cv2.cvtColor(region, cv2.COLOR_RGB2LAB)
+            return cv2.inRange(region, lower, upper)
+
+        result = new_layer_image(img.size) if rgb and roi is None else None
+        tiled = isinstance(img, TiledImage)
+        step = TILED_TILE_SIZE if tiled else y1 - y0
+        for r0 in range(y0, y1, step):
+            box = (x0, r0, x1, min(y1, r0 + step))
+            if tiled:
+                patch = Image.fromarray(binarize(box[1], box[3]))
+            else:
+                # 内存图层按水平条带并行二值化
+                mask = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+                patch = Image.fromarray(self.stripe_pool.fill_rows(mask, lambda a, b: binarize(y0 + a, y0 + b)))
+            if result is not None:
+                result.paste(patch, box[:2])
+            else:
+                self.paste_into_layer(layer, patch.convert("RGB") if rgb else patch, box)
+        if result is not None:
+            layer["image"] = result
+        self.push_history()
+        return roi
+
+    # 历史
+
+    def _snapshot_layers(self):
+        """Tiled snapshot of the layer list for history, sharing unchanged tiles with earlier snapshots."""
+        state = []
+        for layer in self.layers:
+            saved = {k: v for k, v in layer.items() if k not in ("snapshot", "history_dirty")}
+            if layer["image"] is not None:
+                saved["image"] = self._layer_snapshot(layer)
+            state.append(saved)
+        return state
+
+    def _layer_snapshot(self, layer):
+        img = layer["image"]
+        version = layer.get("version", 0)
+        previous = layer.get("snapshot")
+        if previous is not None and previous.tracks(img, version):
+            return previous
+        # 同一图像上的原地编辑只需比较编辑过的区域；图像被替换时逐块比较整幅图像
+        rect = layer.get("history_dirty") if previous is not None and previous.source_is(img) else None
+        snap = LayerSnapshot.capture(img, version, previous, rect, self.history.uniform_tiles)
+        layer["snapshot"] = snap
+        layer["history_dirty"] = None
+        return snap
+
+    def _restore_layers(self, state):
+        """Rebuild live layers from a history state, patching changed tiles into existing images in place."""
+        available = {}
+        for layer in self.layers:
+            snap = layer.get("snapshot")
+            if snap is not None and snap.tracks(layer["image"], layer.get("version", 0)):
+                available.setdefault(snap.lineage, layer)
+        layers = []
+        for saved in state:
+            layer = dict(saved)
+            snap = saved["image"]
+            if snap is not None:
+                live = available.pop(snap.lineage, None)
+                if live is not None and snap.compatible(live["snapshot"]):
+                    layer["image"] = live["image"]
+                    layer["version"] = live.get("version", 0)
+                    if snap is not live["snapshot"]:
+                        layer["snapshot"] = live["snapshot"]
+                        pixels = self.layer_pixels(layer)
+                        rect = snap.patch(pixels if pixels is not None else layer["image"], live["snapshot"])
+                        if rect is not None:
+                            self.layer_modified(layer, rect)
+                else:
+                    layer["image"] = snap.to_image()
+                snap.attach(layer["image"], layer.get("version", 0))
+                layer["snapshot"] = snap
+                layer["history_dirty"] = None
+            layers.append(layer)
+        return layers
+
+    def push_history(self):
+        """Save current state to undo stack."""
+        if not self.record_history:
+            return
+        self.history.push(self._snapshot_layers(), self.current_layer_index)
+        self.pack_idle_layers()
+
+    def pack_idle_layers(self):
+        """Store black/white layers other than the current one as PackedMask.
+
+        Relies on the history snapshot to know a layer is binary, so layers
+        that are not get rejected without scanning their pixels again.
+        """
+        if not self.pack_layers:
+            return
+        for i, layer in enumerate(self.layers):
+            img = layer["image"]
+            if i == self.current_layer_index or img is None or isinstance(img, (PackedMask, TiledImage)):
+                continue
+            snap = layer.get("snapshot")
+            version = layer.get("version", 0)
+            if snap is None or not snap.tracks(img, version) or not snap.binary:
+                continue
+            self._rebind_image(layer, PackedMask.from_array(image_array(img)))
+
+    def set_packing(self, enabled):
+        """Turn storing idle black/white layers as PackedMask on or off."""
+        self.pack_layers = enabled
+        if enabled:
+            self.pack_idle_layers()
+        else:
+            for layer in self.layers:
+                self.unpack_layer(layer)
+
+    def undo(self):
+        """Undo the last action; returns False when there is nothing to undo."""
+        if not self.history.undo_stack:
+            return False
+        state, current_layer_index = self.history.pop_undo(self._snapshot_layers(), self.current_layer_index)
+        self.layers = self._restore_layers(state)
+        self.current_layer_index = current_layer_index
+        self.pack_idle_layers()
+        return True
+
+    def redo(self):
+        """Redo the last undone action; returns False when there is nothing to redo."""
+        if not self.history.redo_stack:
+            return False
+        state, current_layer_index = self.history.pop_redo(self._snapshot_layers(), self.current_layer_index)
+        self.layers = self._restore_layers(state)
+        self.current_layer_index = current_layer_index
+        self.pack_idle_layers()
+        return True
+
+    # 文件
+
+    def open_image(self, path, mode):
+        """Image file at path prepared for import in one of the IMPORT_MODES, before fitting it to the canvas.
+
+        Binarization uses threshold_lab for colour images and threshold_gray
+        for gray ones; the decoded pixels and their LAB form are cached per
+        file, so importing it again with other thresholds only re-compares.
+        """
+        img = Image.open(path)
+        if mode == "gray":
+            return img.convert("L") if img.mode != "L" else img
+        if mode == "color":
+            return img.convert("RGB") if img.mode != "RGB" else img
+        # 解码与 LAB 转换结果按文件缓存，调整阈值后重新导入只需重新比较
+        stat = os.stat(path)
+        source = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        pool = self.stripe_pool
+        if img.mode != "L":
+            Lmin, Lmax, Amin, Amax, Bmin, Bmax = self.threshold_lab
+            lower = np.array([Lmin, Amin, Bmin], dtype=np.uint8)
+            upper = np.array([Lmax, Amax, Bmax], dtype=np.uint8)
+            if img.width * img.height >= PARALLEL_PROCESS_MIN_PIXELS and pool.workers > 1:
+                # 超大图像交给进程池经共享内存逐条转换比较，不在主进程生成整幅 LAB 平面
+                mask = pool.run_shared(lab_in_range_stripe, np.asarray(img.convert("RGB")),
+                                       (img.height, img.width), (lower, upper))
+            else:
+                img_cv = self.planes.get(
+                    ("lab",) + source, lambda: self.planes.convert(np.asarray(img.convert("RGB")), cv2.COLOR_RGB2LAB))
+                mask = pool.fill_rows(np.empty(img_cv.shape[:2], dtype=np.uint8),
+                                      lambda y0, y1: cv2.inRange(img_cv[y0:y1], lower, upper))
+            return image_view(mask)
+        else:
+            gmin, gmax = self.threshold_gray
+            arr = self.planes.get(("gray",) + source, lambda: np.array(img))
+            mask = pool.fill_rows(np.empty(arr.shape, dtype=np.uint8),
+                                  lambda y0, y1: np.where((arr[y0:y1] >= gmin) & (arr[y0:y1] <= gmax), 255, 0))
+            return image_view(mask)
+
+    def open_preview(self, path, mode, size):
+        """Quick low-resolution version of open_image(path, mode), at least size where the image allows.
+
+        JPEGs are decoded directly at 1/2, 1/4 or 1/8 scale with draft();
+        other formats are shrunk with reduce() after decoding. Binarization
+        compares the small image, so the preview only approximates the mask
+        of the full-resolution import.
+        """
+        img = Image.open(path)
+        factor = max(1, min(img.width // size[0], img.height // size[1]))
+        if factor > 1:
+            img.draft("L" if mode == "gray" else None, (img.width // factor, img.height // factor))
+        img = img.convert("L" if mode == "gray" or (mode == "binary" and img.mode == "L") else "RGB")
+        factor = max(1, min(img.width // size[0], img.height // size[1]))
+        if factor > 1:
+            img = img.reduce(factor)
+        if mode != "binary":
+            return img
+        if img.mode == "RGB":
+            Lmin, Lmax, Amin, Amax, Bmin, Bmax = self.threshold_lab
+            lab = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2LAB)
+            mask = cv2.inRange(lab, np.array([Lmin, Amin, Bmin], dtype=np.uint8), np.array([Lmax, Amax, Bmax], dtype=np.uint8))
+        else:
+            gmin, gmax = self.threshold_gray
+            mask = cv2.inRange(np.asarray(img), gmin, gmax)
+        return Image.fromarray(mask)
+
+    def write_composite(self, path):
+        """Save the "L" composite mask; with tiled layers it is composited and written as a PNG strip by strip."""
+        if not self.layers or not any(layer["image"] for layer in self.layers):
+            raise ValueError("没有图像可保存")
+        if not self.is_tiled():
+            binary_for_save(composite_layers(self.layers, self.target_resolution, "L")).save(path)
+            return
+        w, h = self.target_resolution
+        strips = (np.asarray(LayerCompositor.region(self.layers, (w, h), 0, (0, y0, w, min(h, y0 + TILED_TILE_SIZE)), "L"))
+                  for y0 in range(0, h, TILED_TILE_SIZE))
+        write_png_strips(path, (w, h), "L", strips)